@@ -0,0 +1,120 @@
+import argparse
+import datetime
+import gzip
+import hashlib
+import os
+
+import database
+from crawler import reparse_pages
+from sinks import BatchWriter, TableSink
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class PageArchive:
+    def __init__(self, root='archive', level=3, commit_every=100):
+        self.root = root
+        self.level = level
+        self.commit_every = commit_every
+        self.pending = 0
+        os.makedirs(os.path.join(self.root, 'objects'), exist_ok=True)
+        self.index = database.PageIndexTable(database.SQLiteDatabase(os.path.join(self.root, 'index.sqlite')))
+        self.index.create()
+        if zstandard is not None:
+            self.compressor = zstandard.ZstdCompressor(level=level)
+            self.decompressor = zstandard.ZstdDecompressor()
+        self.stored = 0
+        self.deduplicated = 0
+
+    def object_path(self, sha256, extension):
+        return os.path.join(self.root, 'objects', sha256[:2], sha256 + extension)
+
+    def compress(self, data):
+        if zstandard is not None:
+            return self.compressor.compress(data), '.zst'
+        return gzip.compress(data, compresslevel=6), '.gz'
+
+    def add(self, url, html, fetched_at=None):
+        if fetched_at is None:
+            fetched_at = datetime.datetime.utcnow()
+        data = html.encode('utf-8')
+        sha256 = hashlib.sha256(data).hexdigest()
+        if self.find_object(sha256) is None:
+            compressed, extension = self.compress(data)
+            path = self.object_path(sha256, extension)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as outfile:
+                outfile.write(compressed)
+            os.replace(tmp_path, path)
+            self.stored += 1
+        else:
+            self.deduplicated += 1
+        self.index.add_page(url, fetched_at, sha256, len(data))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+        return sha256
+
+    def find_object(self, sha256):
+        for extension in ['.zst', '.gz']:
+            path = self.object_path(sha256, extension)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def get(self, sha256):
+        path = self.find_object(sha256)
+        if path is None:
+            raise KeyError(sha256)
+        with open(path, 'rb') as infile:
+            data = infile.read()
+        if path.endswith('.zst'):
+            if zstandard is None:
+                raise RuntimeError('reading {} requires zstandard'.format(path))
+            data = self.decompressor.decompress(data)
+        else:
+            data = gzip.decompress(data)
+        return data.decode('utf-8')
+
+    def pages(self, since=None, until=None):
+        for url, fetched_at, sha256 in self.index.select_pages(since, until):
+            yield url, self.get(sha256)
+
+    def commit(self):
+        self.index.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.index.database.close()
+
+
+def reparse(archive, callback, since=None, until=None, workers=None, queue_size=64):
+    reparse_pages(archive.pages(since, until), callback, workers=workers, queue_size=queue_size)
+
+
+def parse_date(date_string):
+    return datetime.datetime.strptime(date_string, '%Y-%m-%d')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--archive', default='archive')
+    parser.add_argument('--sqlite', default='reparsed.sqlite')
+    parser.add_argument('--since', type=parse_date)
+    parser.add_argument('--until', type=parse_date)
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    sl_db = database.SQLiteDatabase(args.sqlite)
+    position_table = database.PositionTable(sl_db)
+    vessel_table = database.VesselTable(sl_db)
+    database.MigrationTable(sl_db).migrate([position_table, vessel_table])
+    writer = BatchWriter([TableSink(position_table, vessel_table)], batch_size=1000)
+    page_archive = PageArchive(args.archive)
+    reparse(page_archive, lambda page: writer.write(page.vessel_params), args.since, args.until, args.workers)
+    writer.close()
@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bulkload
+import database
+from bench_write import open_tables, synthetic_params
+
+
+class BenchPositionTable(database.PositionTable):
+    table_name = 'bench_positions'
+
+
+def reset_positions(table):
+    table.drop()
+    query = 'CREATE TABLE {table_name} (idx serial, mmsi integer, imo integer, date timestamp without time zone, ' \
+            'latitude double precision, longitude double precision, speed double precision)'
+    table.database.cursor.execute(query.format(table_name=table.full_table_name))
+    table.create_keys()
+    table.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='database.config')
+    parser.add_argument('--config-name', default='whale_watch')
+    parser.add_argument('--schema', default='public')
+    parser.add_argument('--vessels', type=int, default=1000)
+    parser.add_argument('--reports', type=int, default=100)
+    parser.add_argument('--chunk-rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    pg_db = database.PostgresDatabase(args.config, args.config_name)
+    pg_table = BenchPositionTable(pg_db, schema=args.schema, geometry=False)
+
+    with tempfile.TemporaryDirectory() as directory:
+        sl_db, sl_positions, sl_vessels = open_tables(directory, 'source.sqlite')
+        rows = list(synthetic_params(args.vessels, args.reports))
+        sl_positions.upsert_positions(rows)
+        sl_db.commit()
+
+        reset_positions(pg_table)
+        start = time.perf_counter()
+        for vessel_params in rows:
+            pg_table.add_position(vessel_params)
+        pg_table.commit()
+        row_elapsed = time.perf_counter() - start
+        print('row inserts: {:10.0f} rows/sec'.format(len(rows) / row_elapsed))
+
+        reset_positions(pg_table)
+        loader = bulkload.BulkLoader(pg_table)
+        start = time.perf_counter()
+        loader.load('bench', bulkload.sqlite_source(sl_positions, args.chunk_rows))
+        copy_elapsed = time.perf_counter() - start
+        print('COPY + merge: {:9.0f} rows/sec ({:.1f}x)'.format(len(rows) / copy_elapsed, row_elapsed / copy_elapsed))
+        pg_table.drop()
@@ -0,0 +1,38 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crawler import FleetCrawler
+from stub_server import StubServer
+
+
+def run(n_vessels, concurrency, latency, passes, etags, parse_workers):
+    server = StubServer(latency=latency, etags=etags).start()
+    urls = [server.url('vessels/STUB-IMO-0-MMSI-{}'.format(i)) for i in range(n_vessels)]
+    crawler = FleetCrawler(concurrency=concurrency, timeout=10, parse_workers=parse_workers)
+    for crawl_pass in range(passes):
+        crawled = []
+        start = time.perf_counter()
+        crawler.crawl(urls, crawled.append)
+        elapsed = time.perf_counter() - start
+        print('concurrency={:3d} pass={} vessels={} crawled={} elapsed={:.2f}s ({:.1f} vessels/sec)'.format(
+            concurrency, crawl_pass, n_vessels, len(crawled), elapsed, n_vessels / elapsed))
+    print('  transport: {}'.format(crawler.transport.stats()))
+    crawler.close()
+    server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vessels', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--passes', type=int, default=1)
+    parser.add_argument('--etags', action='store_true')
+    parser.add_argument('--parse-workers', type=int, default=0)
+    args = parser.parse_args()
+    for concurrency in args.concurrency:
+        run(args.vessels, concurrency, args.latency, args.passes, args.etags, args.parse_workers)
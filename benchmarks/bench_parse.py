@@ -0,0 +1,85 @@
+import argparse
+import contextlib
+import glob
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+
+from crawler import reparse_pages
+from webpages import VesselPage
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class LegacyVesselPage(VesselPage):
+    def find_labels(self, label):
+        return self.soup.find_all(text=label)
+
+    def find_label(self, label):
+        return self.soup.find(text=label)
+
+    def in_database(self):
+        self.error_tags = self.soup.find_all('p', 'col-md-8')
+        self.indexed_soup = self.soup
+        return super(LegacyVesselPage, self).in_database()
+
+
+def parse_page(page_class, soup):
+    vessel_page = page_class()
+    vessel_page.soup = soup
+    vessel_page.in_database()
+    vessel_page.parse()
+    return vessel_page.vessel_params
+
+
+def time_parser(page_class, soups, repeat):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(repeat):
+            for soup in soups:
+                parse_page(page_class, soup)
+    elapsed = time.perf_counter() - start
+    return repeat * len(soups) / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pages', nargs='*')
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--workers', type=int, nargs='*', default=[])
+    args = parser.parse_args()
+    paths = args.pages or sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.html')))
+    htmls = [open(path, 'r').read() for path in paths]
+
+    start = time.perf_counter()
+    for i in range(args.repeat):
+        for html in htmls:
+            BeautifulSoup(html, 'lxml')
+    soup_rate = args.repeat * len(htmls) / (time.perf_counter() - start)
+    soups = [BeautifulSoup(html, 'lxml') for html in htmls]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for path, soup in zip(paths, soups):
+            if parse_page(LegacyVesselPage, soup) != parse_page(VesselPage, soup):
+                raise SystemExit('vessel_params differ for {}'.format(path))
+
+    legacy_rate = time_parser(LegacyVesselPage, soups, args.repeat)
+    indexed_rate = time_parser(VesselPage, soups, args.repeat)
+    print('pages: {}'.format(len(paths)))
+    print('soup build:      {:10.1f} pages/sec'.format(soup_rate))
+    print('legacy parse:    {:10.1f} pages/sec'.format(legacy_rate))
+    print('indexed parse:   {:10.1f} pages/sec ({:.1f}x)'.format(indexed_rate, indexed_rate / legacy_rate))
+
+    for workers in args.workers:
+        pages = [('fixture', html) for i in range(args.repeat) for html in htmls]
+        parsed = []
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            reparse_pages(pages, parsed.append, workers=workers)
+        rate = len(parsed) / (time.perf_counter() - start)
+        print('process pool {:2d}: {:10.1f} pages/sec (soup build + parse)'.format(workers, rate))
@@ -0,0 +1,109 @@
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from database import concatenate_arrays
+
+
+def synthetic_positions(n_rows, n_vessels, seed=0, start=datetime.datetime(2018, 1, 1)):
+    rng = numpy.random.default_rng(seed)
+    latitudes = rng.uniform(32.0, 36.0, n_rows)
+    longitudes = rng.uniform(-122.0, -117.0, n_rows)
+    minutes = rng.integers(0, 365 * 24 * 60, n_rows)
+    for i in range(n_rows):
+        yield {'mmsi': 367000000 + i % n_vessels, 'imo': 0, 'date': start + datetime.timedelta(minutes=int(minutes[i])),
+               'latitude': float(latitudes[i]), 'longitude': float(longitudes[i]), 'speed': 5.0}
+
+
+def load(position_table, n_rows, n_vessels, batch_size=10000):
+    batch = []
+    for position in synthetic_positions(n_rows, n_vessels):
+        batch.append(position)
+        if len(batch) >= batch_size:
+            position_table.upsert_positions(batch)
+            batch = []
+    position_table.upsert_positions(batch)
+    position_table.commit()
+
+
+def random_windows(n_queries, size, seed=1):
+    rng = numpy.random.default_rng(seed)
+    for _ in range(n_queries):
+        min_lon = rng.uniform(-122.0, -117.0 - size)
+        min_lat = rng.uniform(32.0, 36.0 - size)
+        start = datetime.datetime(2018, 1, 1) + datetime.timedelta(days=int(rng.integers(0, 300)))
+        yield min_lon, min_lat, min_lon + size, min_lat + size, start, start + datetime.timedelta(days=30)
+
+
+def scan(df, min_lon, min_lat, max_lon, max_lat, start, end):
+    mask = (df.longitude >= min_lon) & (df.longitude <= max_lon) & (df.latitude >= min_lat) & \
+           (df.latitude <= max_lat) & (df.date >= start) & (df.date < end)
+    return df[mask]
+
+
+def report(label, n_rows, latencies):
+    latencies = numpy.array(latencies) * 1000
+    print('{:<10} {:9d} rows  p50 {:8.2f} ms  p99 {:8.2f} ms'.format(
+        label, n_rows, numpy.percentile(latencies, 50), numpy.percentile(latencies, 99)))
+
+
+def run(n_rows, n_vessels, n_queries, size, directory):
+    db = database.SQLiteDatabase(os.path.join(directory, 'query_{}.sqlite'.format(n_rows)))
+    position_table = database.PositionTable(db)
+    position_table.create()
+    load(position_table, n_rows, n_vessels)
+    windows = list(random_windows(n_queries, size))
+
+    latencies = []
+    counts = []
+    for window in windows:
+        start = time.perf_counter()
+        counts.append(len(concatenate_arrays(position_table.positions_in_bbox(*window))['mmsi']))
+        latencies.append(time.perf_counter() - start)
+    report('bbox', n_rows, latencies)
+
+    df = position_table.to_dataframe()
+    df['date'] = df['date'].astype('datetime64[ns]')
+    latencies = []
+    for window, count in zip(windows, counts):
+        start = time.perf_counter()
+        scanned = scan(df, *window)
+        latencies.append(time.perf_counter() - start)
+        if len(scanned) != count:
+            raise SystemExit('bbox query returned {} rows, scan {}'.format(count, len(scanned)))
+    report('scan', n_rows, latencies)
+
+    latencies = []
+    for window in windows:
+        start = time.perf_counter()
+        position_table.nearest(window[0], window[1], k=5, start=window[4], end=window[5])
+        latencies.append(time.perf_counter() - start)
+    report('nearest', n_rows, latencies)
+
+    latencies = []
+    for i in range(n_queries):
+        start = time.perf_counter()
+        position_table.track(mmsi=367000000 + i % n_vessels)
+        latencies.append(time.perf_counter() - start)
+    report('track', n_rows, latencies)
+    db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--vessels', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--size', type=float, default=0.2, help='bounding box size in degrees')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        for n_rows in args.rows:
+            run(n_rows, args.vessels, args.queries, args.size, directory)
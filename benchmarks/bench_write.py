@@ -0,0 +1,71 @@
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from sinks import BatchWriter, TableSink
+
+
+def synthetic_params(n_vessels, n_reports, start=datetime.datetime(2018, 5, 23)):
+    for report in range(n_reports):
+        date = start + datetime.timedelta(minutes=10 * report)
+        for i in range(n_vessels):
+            yield {'url': 'https://www.vesselfinder.com/vessels/STUB-IMO-0-MMSI-{}'.format(367000000 + i),
+                   'name': 'STUB {}'.format(i), 'date': date, 'ship_type': 'Passenger ship', 'country': 'USA',
+                   'latitude': 34.0 + 0.001 * report, 'longitude': -119.6 - 0.001 * i, 'speed': 6.4,
+                   'imo': 0, 'mmsi': 367000000 + i, 'built': None, 'length': 23.0, 'width': 7.0, 'gt': None}
+
+
+def open_tables(directory, name):
+    db = database.SQLiteDatabase(os.path.join(directory, name))
+    position_table = database.PositionTable(db)
+    vessel_table = database.VesselTable(db)
+    position_table.create()
+    vessel_table.create()
+    return db, position_table, vessel_table
+
+
+def per_row(position_table, vessel_table, rows):
+    for vessel_params in rows:
+        position_table.upsert_position(vessel_params)
+        position_table.commit()
+        vessel_table.upsert_vessel(vessel_params)
+        vessel_table.commit()
+
+
+def batched(position_table, vessel_table, rows, batch_size):
+    writer = BatchWriter([TableSink(position_table, vessel_table)], batch_size=batch_size)
+    for vessel_params in rows:
+        writer.write(vessel_params)
+    writer.flush()
+
+
+def report(label, n_rows, elapsed):
+    print('{:<22} {:8d} rows {:8.2f}s {:10.1f} rows/sec'.format(label, n_rows, elapsed, n_rows / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vessels', type=int, default=200)
+    parser.add_argument('--reports', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+    rows = list(synthetic_params(args.vessels, args.reports))
+    with tempfile.TemporaryDirectory() as directory:
+        db, position_table, vessel_table = open_tables(directory, 'per_row.sqlite')
+        start = time.perf_counter()
+        per_row(position_table, vessel_table, rows)
+        report('per-row upsert+commit', len(rows), time.perf_counter() - start)
+        expected = (sorted(position_table.select_all()), sorted(vessel_table.select_all()))
+
+        db, position_table, vessel_table = open_tables(directory, 'batched.sqlite')
+        start = time.perf_counter()
+        batched(position_table, vessel_table, rows, args.batch_size)
+        report('batched writer', len(rows), time.perf_counter() - start)
+        if (sorted(position_table.select_all()), sorted(vessel_table.select_all())) != expected:
+            raise SystemExit('batched writer produced different tables')
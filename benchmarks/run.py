@@ -0,0 +1,197 @@
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from crawler import FleetCrawler
+from sinks import CsvSink, ParquetSink, TableSink, pyarrow
+from webpages import parse_vessel_html
+
+from bench_write import synthetic_params
+from stub_server import FIXTURE_DIR, StubServer
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+LOWER_IS_BETTER = ('latency_p50', 'latency_p99', 'peak_rss_mb')
+
+
+def bench_crawl(n_vessels, concurrency, latency):
+    server = StubServer(latency=latency).start()
+    urls = (server.url('vessels/STUB-IMO-0-MMSI-{}'.format(367000000 + i)) for i in range(n_vessels))
+    crawler = FleetCrawler(concurrency=concurrency, timeout=10)
+    crawled = []
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        crawler.crawl(urls, crawled.append)
+    elapsed = time.perf_counter() - start
+    crawler.close()
+    server.stop()
+    if len(crawled) != n_vessels:
+        raise SystemExit('crawled {} of {} vessels'.format(len(crawled), n_vessels))
+    stats = crawler.transport.stats()
+    return {'pages_per_sec': n_vessels / elapsed,
+            'latency_p50': stats['latency_p50'], 'latency_p99': stats['latency_p99']}
+
+
+def bench_parse(repeat):
+    pages = [open(path, 'r').read() for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.html')))]
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for html in pages:
+                parse_vessel_html('https://www.vesselfinder.com/vessels/STUB', html)
+        elapsed = time.perf_counter() - start
+    return {'pages_per_sec': repeat * len(pages) / elapsed}
+
+
+def open_sinks(directory, pg_config=None):
+    sl_db = database.SQLiteDatabase(os.path.join(directory, 'bench.sqlite'))
+    sl_position_table = database.PositionTable(sl_db)
+    sl_vessel_table = database.VesselTable(sl_db)
+    sl_position_table.create()
+    sl_vessel_table.create()
+    sinks = {'sqlite': TableSink(sl_position_table, sl_vessel_table),
+             'csv': CsvSink(os.path.join(directory, 'positions.csv'))}
+    if pyarrow is not None:
+        sinks['parquet'] = ParquetSink(os.path.join(directory, 'positions'), compact_interval=None)
+    if pg_config is not None:
+        config_file, config_name = pg_config
+        pg_db = database.PostgresDatabase(config_file, config_name)
+        pg_position_table = database.PositionTable(pg_db, schema='bench')
+        pg_vessel_table = database.VesselTable(pg_db, schema='bench')
+        pg_db.cursor.execute('DROP SCHEMA IF EXISTS bench CASCADE')
+        pg_db.cursor.execute('CREATE SCHEMA bench')
+        pg_position_table.create()
+        pg_vessel_table.create()
+        sinks['postgres'] = TableSink(pg_position_table, pg_vessel_table)
+    return sinks
+
+
+def bench_write(n_vessels, reports, batch_size, pg_config=None):
+    results = dict()
+    with tempfile.TemporaryDirectory() as directory:
+        for name, sink in open_sinks(directory, pg_config).items():
+            n_rows = 0
+            batch = []
+            start = time.perf_counter()
+            for vessel_params in synthetic_params(n_vessels, reports):
+                batch.append(vessel_params)
+                if len(batch) >= batch_size:
+                    sink.write_batch(batch, batch)
+                    n_rows += len(batch)
+                    batch = []
+            if batch:
+                sink.write_batch(batch, batch)
+                n_rows += len(batch)
+            sink.close()
+            results[name] = {'rows_per_sec': n_rows / (time.perf_counter() - start)}
+    return results
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def best_of(repeat, func, *args):
+    best = flatten(func(*args))
+    for _ in range(repeat - 1):
+        for key, value in flatten(func(*args)).items():
+            if key.endswith(LOWER_IS_BETTER):
+                best[key] = min(best[key], value)
+            else:
+                best[key] = max(best[key], value)
+    return unflatten(best)
+
+
+def unflatten(flat):
+    results = dict()
+    for key, value in flat.items():
+        parts = key.split('.')
+        node = results
+        for part in parts[:-1]:
+            node = node.setdefault(part, dict())
+        node[parts[-1]] = value
+    return results
+
+
+def flatten(results, prefix=''):
+    flat = dict()
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, baseline_value in sorted(baseline.items()):
+        value = results.get(key)
+        if value is None or not baseline_value:
+            continue
+        change = (value - baseline_value) / baseline_value
+        if key.endswith(LOWER_IS_BETTER):
+            change = -change
+        flag = ''
+        if change < -tolerance:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        print('{:<40} {:12.4g} {:12.4g} {:+7.1%}{}'.format(key, baseline_value, value, change, flag))
+    return regressions
+
+
+def run(args):
+    results = {'crawl': dict(), 'write': dict()}
+    results['parse'] = best_of(args.repeat, bench_parse, args.parse_repeat)
+    print('parse: {}'.format(results['parse']))
+    for n_vessels in args.fleets:
+        if n_vessels <= args.max_crawl:
+            results['crawl'][str(n_vessels)] = best_of(args.repeat, bench_crawl, n_vessels, args.concurrency,
+                                                       args.latency)
+            print('crawl {}: {}'.format(n_vessels, results['crawl'][str(n_vessels)]))
+        write_results = best_of(args.repeat, bench_write, n_vessels, args.reports, args.batch_size, args.pg_config)
+        for name, result in write_results.items():
+            results['write'].setdefault(name, dict())[str(n_vessels)] = result
+            print('write {} {}: {}'.format(name, n_vessels, result))
+    results['peak_rss_mb'] = peak_rss_mb()
+    print('peak rss: {:.1f} MB'.format(results['peak_rss_mb']))
+    return flatten(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fleets', type=int, nargs='+', default=[10, 1000, 100000])
+    parser.add_argument('--max-crawl', type=int, default=1000,
+                        help='only crawl fleets up to this size against the stub server')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--reports', type=int, default=3)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--parse-repeat', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=3, help='report the best of this many runs')
+    parser.add_argument('--pg-config', nargs=2, metavar=('CONFIG_FILE', 'CONFIG_NAME'))
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as outfile:
+            json.dump(results, outfile, indent=1, sort_keys=True)
+        print('Saved baseline to {}'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as infile:
+            baseline = json.load(infile)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            raise SystemExit('{} regressions against {}'.format(len(regressions), args.baseline))
@@ -0,0 +1,66 @@
+import glob
+import hashlib
+import http.server
+import os
+import threading
+import time
+import zlib
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        pages = self.server.pages
+        body = pages[zlib.crc32(self.path.encode('utf-8')) % len(pages)]
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.server.etags and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if self.server.etags:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, fixtures=None, port=0, etags=False):
+        super(StubServer, self).__init__(('127.0.0.1', port), StubHandler)
+        self.latency = latency
+        self.etags = etags
+        if fixtures is None:
+            fixtures = sorted(glob.glob(os.path.join(FIXTURE_DIR, '*.html')))
+        self.pages = [open(path, 'rb').read() for path in fixtures]
+        self.thread = None
+
+    def url(self, path=''):
+        return 'http://127.0.0.1:{}/{}'.format(self.server_address[1], path.lstrip('/'))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    server = StubServer(latency=0.1, port=8000)
+    print('Serving fixtures on {}'.format(server.url()))
+    server.serve_forever()
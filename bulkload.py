@@ -0,0 +1,126 @@
+import argparse
+import csv
+import io
+import json
+import os
+import time
+
+import database
+
+
+class Checkpoint:
+    def __init__(self, path=None):
+        self.path = path
+        self.positions = dict()
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, 'r') as infile:
+                self.positions = json.load(infile)
+
+    def get(self, source_name):
+        return self.positions.get(source_name)
+
+    def set(self, source_name, position):
+        self.positions[source_name] = position
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(self.positions, outfile)
+        os.replace(tmp_path, self.path)
+
+
+def sqlite_source(table, chunk_rows=100000, start_after=None):
+    names = ','.join(name for name, column_type in table.copy_columns)
+    query = 'SELECT rowid, {names} FROM {table_name} WHERE rowid > ? ORDER BY rowid LIMIT ?'
+    query = query.format(names=names, table_name=table.full_table_name)
+    last_rowid = start_after or 0
+    while True:
+        table.database.cursor.execute(query, (last_rowid, chunk_rows))
+        rows = table.database.cursor.fetchall()
+        if len(rows) == 0:
+            return
+        last_rowid = rows[-1][0]
+        yield last_rowid, [row[1:] for row in rows]
+
+
+def csv_source(path, columns, fieldnames=None, chunk_rows=100000, start_after=None):
+    skip = start_after or 0
+    line_number = 0
+    rows = []
+    with open(path, 'r', newline='') as infile:
+        for record in csv.DictReader(infile, fieldnames=fieldnames):
+            line_number += 1
+            if line_number <= skip:
+                continue
+            rows.append(tuple(record.get(column) for column in columns))
+            if len(rows) >= chunk_rows:
+                yield line_number, rows
+                rows = []
+    if len(rows) > 0:
+        yield line_number, rows
+
+
+class BulkLoader:
+    def __init__(self, table, checkpoint=None):
+        self.table = table
+        if checkpoint is None:
+            checkpoint = Checkpoint()
+        self.checkpoint = checkpoint
+        self.staging_name = '{}_staging'.format(table.table_name)
+        self.names = [name for name, column_type in table.copy_columns]
+
+    def copy_rows(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(['' if value is None else value for value in row])
+        buffer.seek(0)
+        query = 'COPY {staging_name} ({names}) FROM STDIN WITH (FORMAT csv)'
+        query = query.format(staging_name=self.staging_name, names=','.join(self.names))
+        self.table.database.copy_expert(query, buffer)
+
+    def load(self, source_name, source):
+        loaded = 0
+        start = time.perf_counter()
+        for position, rows in source:
+            try:
+                self.table.create_staging(self.staging_name)
+                self.copy_rows(rows)
+                self.table.merge_staging(self.staging_name)
+                self.table.commit()
+            except Exception:
+                self.table.database.rollback()
+                raise
+            self.checkpoint.set(source_name, position)
+            loaded += len(rows)
+            elapsed = time.perf_counter() - start
+            print('{}: loaded {} rows ({:.0f} rows/sec), checkpoint {}'.format(
+                source_name, loaded, loaded / elapsed, position))
+        return loaded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='database.config')
+    parser.add_argument('--config-name', default='whale_watch')
+    parser.add_argument('--schema', default='public')
+    parser.add_argument('--table', choices=['positions', 'vessels'], default='positions')
+    parser.add_argument('--sqlite')
+    parser.add_argument('--csv', nargs='*', default=[])
+    parser.add_argument('--fieldnames', nargs='*')
+    parser.add_argument('--chunk-rows', type=int, default=100000)
+    parser.add_argument('--checkpoint', default='bulkload_checkpoint.json')
+    args = parser.parse_args()
+
+    table_classes = {'positions': database.PositionTable, 'vessels': database.VesselTable}
+    table_class = table_classes[args.table]
+    pg_db = database.PostgresDatabase(args.config, args.config_name)
+    loader = BulkLoader(table_class(pg_db, schema=args.schema), Checkpoint(args.checkpoint))
+    if args.sqlite:
+        source_table = table_class(database.SQLiteDatabase(args.sqlite))
+        source_name = 'sqlite:{}:{}'.format(os.path.abspath(args.sqlite), args.table)
+        loader.load(source_name, sqlite_source(source_table, args.chunk_rows, loader.checkpoint.get(source_name)))
+    for path in args.csv:
+        source_name = 'csv:{}:{}'.format(os.path.abspath(path), args.table)
+        loader.load(source_name, csv_source(path, loader.names, args.fieldnames, args.chunk_rows,
+                                            loader.checkpoint.get(source_name)))
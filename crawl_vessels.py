@@ -1,49 +1,294 @@
-from webpages import VesselPage
-import database
+import argparse
+import configparser
+import datetime
+import os
+import subprocess
+import sys
 import time
-import pandas
 
-sl_db = database.SQLiteDatabase('vessels.sqlite')
-sl_position_table = database.PositionTable(sl_db)
-sl_vessel_table = database.VesselTable(sl_db)
+CONFIG_FILE = 'crawl.config'
+DEFAULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), CONFIG_FILE)
 
-pg_db = database.PostgresDatabase('database.config', 'whale_watch')
-pg_position_table = database.PositionTable(pg_db, schema='public')
-pg_vessel_table = database.VesselTable(pg_db, schema='public')
 
-vessel_page = VesselPage()
-ship_urls = ['https://www.vesselfinder.com/vessels/CONDOR-EXPRESS-IMO-0-MMSI-367568350']
+def load_config(path=CONFIG_FILE):
+    config = configparser.ConfigParser()
+    with open(DEFAULTS_FILE, 'r') as infile:
+        config.read_file(infile)
+    config.read(path)
+    return config
 
 
-def get_ship(url):
-    success = vessel_page.download(url)    
-    in_database = vessel_page.in_database()
-    if success and in_database:        
-        vessel_page.to_file()        
-        vessel_page.parse()
-        vessel_params = vessel_page.vessel_params
+def config_list(config, section, option):
+    return config.get(section, option).split()
+
+
+def open_tables(config, names=None):
+    import database
+    tables = dict()
+    if config.get('sinks', 'sqlite') and (names is None or 'sqlite' in names):
+        sl_db = database.SQLiteDatabase(config.get('sinks', 'sqlite'))
+        tables['sqlite'] = (database.PositionTable(sl_db), database.VesselTable(sl_db))
+    if config.get('sinks', 'postgres') and (names is None or 'postgres' in names):
+        pg_db = database.PostgresDatabase(config.get('sinks', 'postgres_config'), config.get('sinks', 'postgres'))
+        schema = config.get('sinks', 'postgres_schema') or None
+        tables['postgres'] = (database.PositionTable(pg_db, schema=schema),
+                              database.VesselTable(pg_db, schema=schema))
+    return tables
+
+
+def migrate_tables(tables):
+    import database
+    for position_table, vessel_table in tables.values():
+        migration_table = database.MigrationTable(position_table.database, schema=position_table.schema)
+        migration_table.migrate([position_table, vessel_table])
+
+
+def open_sink_workers(config, tables, parquet_root=None):
+    from sinks import ParquetSink, SinkWorker, TableSink
+    queue_size = config.getint('sinks', 'queue_size')
+    spool_dir = config.get('sinks', 'spool')
+    sink_workers = [SinkWorker(TableSink(position_table, vessel_table), name=name, queue_size=queue_size,
+                               spool_dir=spool_dir)
+                    for name, (position_table, vessel_table) in tables.items()]
+    if parquet_root:
+        sink_workers.append(SinkWorker(ParquetSink(parquet_root), name='parquet',
+                                       queue_size=queue_size, spool_dir=spool_dir))
+    return sink_workers
+
+
+def crawl(config, args):
+    from archive import PageArchive
+    from crawler import FleetCrawler
+    from fleet_state import FleetState
+    from frontier import Frontier
+    from metrics import CycleProfiler, JsonSummary, MetricsServer, registry
+    from scheduler import PollScheduler
+    from sinks import BatchWriter, ChangeCache
+    from transport import DeadLetterQueue, RetryPolicy
+
+    tables = open_tables(config)
+    migrate_tables(tables)
+    sink_workers = open_sink_workers(config, tables, config.get('sinks', 'parquet'))
+    sinks = list(sink_workers)
+    fleet_state = None
+    if config.get('sinks', 'fleet_state'):
+        fleet_state = FleetState(config.get('sinks', 'fleet_state'))
+        sinks.append(fleet_state)
+    change_cache = None
+    if config.get('sinks', 'change_cache'):
+        change_cache = ChangeCache(config.get('sinks', 'change_cache'))
+    writer = BatchWriter(sinks, batch_size=config.getint('sinks', 'batch_size'),
+                         flush_interval=config.getint('sinks', 'flush_interval'), change_cache=change_cache)
+    page_archive = PageArchive(config.get('crawl', 'archive'))
+
+    frontier = Frontier(config.get('fleet', 'frontier'))
+    frontier.add_many(config_list(config, 'fleet', 'seed_urls'))
+    for path in config_list(config, 'fleet', 'seed_files'):
+        frontier.seed_file(path)
+    for name in config_list(config, 'fleet', 'seed_table'):
+        if name in tables:
+            frontier.seed_table(tables[name][1])
+    frontier_batch = config.getint('fleet', 'frontier_batch')
+
+    retry_policy = RetryPolicy(max_attempts=config.getint('crawl', 'max_attempts'))
+    scheduler = PollScheduler(db=frontier.table.database,
+                              requests_per_minute=config.getint('crawl', 'requests_per_minute'))
+    legacy_schedule = config.get('crawl', 'legacy_schedule')
+    if legacy_schedule and os.path.exists(legacy_schedule):
+        print('Imported {} vessels from {}'.format(scheduler.import_json(legacy_schedule), legacy_schedule))
+        os.replace(legacy_schedule, legacy_schedule + '.imported')
+    if args.distributed:
+        from workqueue import WorkQueue
+        queue_database = config.get('queue', 'database')
+        if queue_database not in tables:
+            raise SystemExit('--distributed needs the {} sink enabled in {}'.format(queue_database, args.config))
+        queue_table = open_tables(config, [queue_database])[queue_database][0]
+        scheduler = WorkQueue(queue_table.database, schema=queue_table.schema,
+                              n_shards=config.getint('queue', 'shards'),
+                              lease_seconds=config.getint('queue', 'lease_seconds'),
+                              heartbeat_interval=config.getint('queue', 'heartbeat_interval'),
+                              worker_timeout=config.getint('queue', 'worker_timeout'),
+                              claim_size=config.getint('queue', 'claim_size'),
+                              scheduler=scheduler)
+        print('Worker {} owns {} of {} shards'.format(scheduler.worker_id, len(scheduler.shards), scheduler.n_shards))
+    crawler = FleetCrawler(concurrency=config.getint('crawl', 'concurrency'),
+                           host_rate=config.getfloat('crawl', 'host_rate'),
+                           timeout=config.getint('crawl', 'timeout'),
+                           retry_policy=retry_policy,
+                           dead_letters=DeadLetterQueue(config.get('crawl', 'dead_letters')),
+                           parse_workers=config.getint('crawl', 'parse_workers'))
+    metrics_summary = JsonSummary(config.get('crawl', 'metrics_summary'),
+                                  interval=config.getint('crawl', 'summary_interval'))
+    profiler = CycleProfiler(config.get('crawl', 'profiles'))
+
+    def store_ship(page):
+        vessel_params = page.vessel_params
+        page_archive.add(vessel_params['url'], page.html)
         print('Vessel Name: {} - url: {}'.format(vessel_params['name'], vessel_params['url']))
-        upsert_data(vessel_params)
-        
-
-def upsert_data(vessel_params):
-    sl_position_table.upsert_position(vessel_params)
-    sl_position_table.commit()
-    sl_vessel_table.upsert_vessel(vessel_params)
-    sl_vessel_table.commit()
-    pg_position_table.upsert_position(vessel_params)
-    pg_position_table.commit()
-    pg_vessel_table.upsert_vessel(vessel_params)
-    pg_vessel_table.commit()
-    df = pandas.DataFrame(vessel_params, index=['mmsi'])
-    with open('positions.csv', 'a') as csv:
-      df.to_csv(path_or_buf=csv, header=False)
+        scheduler.record_success(vessel_params['url'], vessel_params)
+        writer.write(vessel_params)
 
+    if config.getint('crawl', 'metrics_port'):
+        MetricsServer(config.getint('crawl', 'metrics_port')).start()
+    profiler.install_signal()
+    try:
+        while True:
+            frontier.admit(scheduler, frontier_batch)
+            due_urls = scheduler.due_urls()
+            if due_urls:
+                with profiler.cycle(), registry.timer('crawl_cycle_seconds'):
+                    failed_urls = set(crawler.crawl(due_urls, store_ship))
+                    failed_urls.update(crawler.dead_letters.drain())
+                    for failed_url in failed_urls:
+                        scheduler.record_failure(failed_url)
+                    scheduler.settle(crawler.unchanged_urls)
+                    writer.flush_sinks()
+                    scheduler.save()
+                    if fleet_state is not None:
+                        fleet_state.snapshot()
+                metrics_summary.write_if_due()
+                for sink_worker in sink_workers:
+                    print('Sink {}: {}'.format(sink_worker.name, sink_worker.stats()))
+                print('Transport: {}'.format(crawler.transport.stats()))
+                print('Retries: {}'.format(crawler.retry_stats()))
+                print('Unchanged vessels skipped: {}'.format(writer.skipped))
+            if args.once:
+                break
+            time.sleep(min(60, scheduler.seconds_until_next()))
+    finally:
+        crawler.close()
+        writer.close()
+        page_archive.close()
+        if args.distributed:
+            scheduler.close()
+
+
+def reparse(config, args):
+    from archive import PageArchive, reparse as reparse_archive
+    from sinks import BatchWriter
+
+    tables = open_tables(config, args.sinks)
+    migrate_tables(tables)
+    if args.parquet and os.path.abspath(args.parquet) == os.path.abspath(config.get('sinks', 'parquet')):
+        raise SystemExit('--parquet must not be the crawl Parquet root, which is append-only')
+    writer = BatchWriter(open_sink_workers(config, tables, args.parquet), batch_size=1000)
+    page_archive = PageArchive(config.get('crawl', 'archive'))
+    try:
+        reparse_archive(page_archive, lambda page: writer.write(page.vessel_params), args.since, args.until,
+                        args.workers)
+    finally:
+        writer.close()
+
+
+def export(config, args):
+    import database
+    from trajectory import CleanPositionTable
+
+    position_table, vessel_table = open_tables(config, [args.sink])[args.sink]
+    table_classes = {'positions': database.PositionTable, 'positions_clean': CleanPositionTable,
+                     'vessels': database.VesselTable}
+    table = table_classes[args.table](position_table.database, schema=position_table.schema)
+    query = None
+    if args.since is not None or args.until is not None:
+        if args.table == 'vessels':
+            raise SystemExit('--since and --until only apply to position tables')
+        conditions = []
+        if args.since is not None:
+            conditions.append("date >= '{}'".format(args.since.isoformat(' ')))
+        if args.until is not None:
+            conditions.append("date < '{}'".format(args.until.isoformat(' ')))
+        query = 'SELECT * FROM {table_name} WHERE ' + ' AND '.join(conditions)
+    n_rows = 0
+    writer = None
+    try:
+        for df in table.iter_dataframes(query, chunksize=args.chunk_rows):
+            if args.output.endswith('.parquet'):
+                import pyarrow
+                import pyarrow.parquet
+                batch = pyarrow.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(args.output, batch.schema, compression='zstd')
+                writer.write_table(batch)
+            else:
+                df.to_csv(args.output, mode='w' if n_rows == 0 else 'a', header=n_rows == 0, index=False)
+            n_rows += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    print('Exported {} rows from {} to {}'.format(n_rows, table.full_table_name, args.output))
 
-if __name__ == '__main__':
-  while True:
-    for ship_url in ship_urls:
-      get_ship(ship_url)
-    time.sleep(600)
-    
 
+def migrate(config, args):
+    migrate_tables(open_tables(config, args.sinks))
+
+
+def geom_refresh(config, args):
+    tables = open_tables(config, ['postgres'])
+    if 'postgres' not in tables:
+        raise SystemExit('geom-refresh needs a postgres sink in {}'.format(args.config))
+    position_table = tables['postgres'][0]
+    position_table.backfill_geometries(batch_size=args.batch_size)
+    position_table.make_geometries_index()
+
+
+def bench(config, args):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'run.py')
+    return subprocess.call([sys.executable, script] + args.bench_args)
+
+
+def parse_date(date_string):
+    return datetime.datetime.strptime(date_string, '%Y-%m-%d')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=CONFIG_FILE,
+                        help='overrides applied on top of the crawl.config shipped with this script')
+    commands = parser.add_subparsers(dest='command')
+
+    crawl_parser = commands.add_parser('crawl')
+    crawl_parser.add_argument('--once', action='store_true', help='stop after the first crawl cycle')
+    crawl_parser.add_argument('--distributed', action='store_true',
+                              help='claim vessels from the shared work queue instead of the local schedule')
+    crawl_parser.set_defaults(func=crawl)
+
+    reparse_parser = commands.add_parser('reparse')
+    reparse_parser.add_argument('--since', type=parse_date)
+    reparse_parser.add_argument('--until', type=parse_date)
+    reparse_parser.add_argument('--workers', type=int)
+    reparse_parser.add_argument('--sinks', nargs='+', choices=['sqlite', 'postgres'])
+    reparse_parser.add_argument('--parquet', metavar='DIR', help='also write positions to a separate Parquet root')
+    reparse_parser.set_defaults(func=reparse)
+
+    export_parser = commands.add_parser('export')
+    export_parser.add_argument('output')
+    export_parser.add_argument('--sink', choices=['sqlite', 'postgres'], default='sqlite')
+    export_parser.add_argument('--table', choices=['positions', 'positions_clean', 'vessels'], default='positions')
+    export_parser.add_argument('--since', type=parse_date)
+    export_parser.add_argument('--until', type=parse_date)
+    export_parser.add_argument('--chunk-rows', type=int, default=100000)
+    export_parser.set_defaults(func=export)
+
+    migrate_parser = commands.add_parser('migrate')
+    migrate_parser.add_argument('--sinks', nargs='+', choices=['sqlite', 'postgres'])
+    migrate_parser.set_defaults(func=migrate)
+
+    geom_parser = commands.add_parser('geom-refresh')
+    geom_parser.add_argument('--batch-size', type=int, default=10000)
+    geom_parser.set_defaults(func=geom_refresh)
+
+    bench_parser = commands.add_parser('bench')
+    bench_parser.add_argument('bench_args', nargs=argparse.REMAINDER)
+    bench_parser.set_defaults(func=bench)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command is None:
+        args = build_parser().parse_args(['--config', args.config, 'crawl'])
+    return args.func(load_config(args.config), args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
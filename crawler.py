@@ -0,0 +1,200 @@
+import collections
+import concurrent.futures
+import heapq
+import multiprocessing
+import threading
+import time
+import urllib.parse
+
+from metrics import registry
+from transport import RETRYABLE_ERRORS, CircuitBreaker, CircuitOpenError, DeadLetterQueue, RetryPolicy, Transport
+from webpages import VesselPage, parse_vessel_html
+
+
+class HostRateLimiter:
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.next_slot = dict()
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.rate:
+            return
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def parse_executor(workers=None):
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                  mp_context=multiprocessing.get_context('forkserver'))
+
+
+def reparse_pages(pages, callback, workers=None, queue_size=64):
+    with parse_executor(workers) as executor:
+        parses = dict()
+        for url, html in pages:
+            if len(parses) >= queue_size:
+                finish_parses(parses, callback, concurrent.futures.FIRST_COMPLETED)
+            parses[executor.submit(parse_vessel_html, url, html)] = (url, html)
+        finish_parses(parses, callback, concurrent.futures.ALL_COMPLETED)
+
+
+def finish_parses(parses, callback, return_when, timeout=None, unchanged_urls=None):
+    done, pending = concurrent.futures.wait(parses, timeout=timeout, return_when=return_when)
+    for future in done:
+        url, html = parses.pop(future)
+        try:
+            vessel_params = future.result()
+        except Exception as e:
+            print('Failed to parse {}: {}'.format(url, e))
+            continue
+        if vessel_params is None:
+            if unchanged_urls is not None:
+                unchanged_urls.append(url)
+            continue
+        vessel_page = VesselPage()
+        vessel_page.html = html
+        vessel_page.vessel_params = vessel_params
+        callback(vessel_page)
+
+
+class FleetCrawler:
+    def __init__(self, concurrency=8, host_rate=None, timeout=30, transport=None,
+                 retry_policy=None, circuit_breaker=None, dead_letters=None,
+                 parse_workers=0, parse_queue_size=64):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.rate_limiter = HostRateLimiter(host_rate)
+        if transport is None:
+            transport = Transport(pool_size=concurrency)
+        self.transport = transport
+        if retry_policy is None:
+            retry_policy = RetryPolicy()
+        self.retry_policy = retry_policy
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker()
+        self.circuit_breaker = circuit_breaker
+        if dead_letters is None:
+            dead_letters = DeadLetterQueue()
+        self.dead_letters = dead_letters
+        self.parse_workers = parse_workers
+        self.parse_queue_size = parse_queue_size
+        self.parse_pool = None
+        self.retries = 0
+        self.give_ups = 0
+        self.failed_urls = []
+        self.unchanged_urls = []
+
+    def fetch_vessel(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        if not self.circuit_breaker.allow(host):
+            raise CircuitOpenError(host)
+        self.rate_limiter.wait(url)
+        vessel_page = VesselPage(self.transport)
+        try:
+            if self.parse_workers:
+                success = vessel_page.fetch(url, timeout=self.timeout)
+            else:
+                success = vessel_page.download(url, timeout=self.timeout)
+        except RETRYABLE_ERRORS:
+            self.circuit_breaker.record_failure(host)
+            raise
+        self.circuit_breaker.record_success(host)
+        if not success:
+            if vessel_page.not_modified:
+                self.unchanged_urls.append(url)
+            return None
+        if self.parse_workers:
+            return vessel_page
+        if vessel_page.in_database():
+            vessel_page.parse()
+            return vessel_page
+        self.unchanged_urls.append(url)
+        return None
+
+    def crawl(self, urls, callback):
+        ready = collections.deque((url, 1) for url in urls)
+        retry_heap = []
+        self.failed_urls = []
+        self.unchanged_urls = []
+        fetches = dict()
+        parses = dict()
+        if self.parse_workers and self.parse_pool is None:
+            self.parse_pool = parse_executor(self.parse_workers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as fetch_executor:
+            while ready or retry_heap or fetches or parses:
+                now = time.monotonic()
+                while retry_heap and retry_heap[0][0] <= now:
+                    due, url, attempt = heapq.heappop(retry_heap)
+                    ready.append((url, attempt))
+                while ready and len(fetches) < 2 * self.concurrency and len(parses) < self.parse_queue_size:
+                    url, attempt = ready.popleft()
+                    fetches[fetch_executor.submit(self.fetch_vessel, url)] = (url, attempt)
+                registry.set_gauge('crawl_ready', len(ready))
+                registry.set_gauge('crawl_retry_waiting', len(retry_heap))
+                registry.set_gauge('crawl_fetches_in_flight', len(fetches))
+                registry.set_gauge('crawl_parses_in_flight', len(parses))
+                wait_time = None
+                if retry_heap:
+                    wait_time = max(0, retry_heap[0][0] - now)
+                if not fetches and not parses:
+                    time.sleep(wait_time)
+                    continue
+                done, pending = concurrent.futures.wait(
+                    list(fetches) + list(parses), timeout=wait_time, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future in parses:
+                        continue
+                    url, attempt = fetches.pop(future)
+                    vessel_page = self.fetch_result(future, url, attempt, retry_heap)
+                    if vessel_page is None:
+                        continue
+                    if self.parse_workers:
+                        future = self.parse_pool.submit(parse_vessel_html, url, vessel_page.html)
+                        parses[future] = (url, vessel_page.html)
+                    else:
+                        callback(vessel_page)
+                if parses:
+                    finish_parses(parses, callback, concurrent.futures.FIRST_COMPLETED, timeout=0,
+                                  unchanged_urls=self.unchanged_urls)
+        return self.failed_urls
+
+    def fetch_result(self, future, url, attempt, retry_heap):
+        try:
+            return future.result()
+        except CircuitOpenError as e:
+            self.give_up(url, 'circuit open for {}'.format(e))
+        except RETRYABLE_ERRORS as e:
+            if attempt >= self.retry_policy.max_attempts:
+                self.give_up(url, e.__class__.__name__)
+            else:
+                self.retries += 1
+                registry.increment('crawl_retries_total')
+                due = time.monotonic() + self.retry_policy.delay(attempt)
+                heapq.heappush(retry_heap, (due, url, attempt + 1))
+        except Exception as e:
+            registry.increment('crawl_errors_total')
+            print('Failed to crawl {}: {}'.format(url, e))
+            self.failed_urls.append(url)
+        return None
+
+    def give_up(self, url, reason):
+        self.give_ups += 1
+        registry.increment('crawl_give_ups_total')
+        self.failed_urls.append(url)
+        print('Giving up on {} ({}), leaving it to the scheduler'.format(url, reason))
+        self.dead_letters.add(url)
+
+    def close(self):
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+            self.parse_pool = None
+
+    def retry_stats(self):
+        return {'retries': self.retries, 'circuit_trips': self.circuit_breaker.trips,
+                'give_ups': self.give_ups, 'dead_letters': len(self.dead_letters)}
@@ -1,21 +1,91 @@
 import sqlite3
 import configparser
-import psycopg2
-import psycopg2.extras
-import pandas
-import sqlalchemy
+import datetime
+import time
+import uuid
+
+POSITION_COLUMNS = [('mmsi', 'int64'), ('imo', 'int64'), ('date', 'datetime64[s]'),
+                    ('latitude', 'float64'), ('longitude', 'float64'), ('speed', 'float64')]
+
+
+def dataframe_records(df):
+    import pandas
+    columns = dict()
+    for column in df.columns:
+        series = df[column]
+        if pandas.api.types.is_datetime64_any_dtype(series):
+            values = [None if pandas.isnull(value) else value.to_pydatetime() for value in series]
+        else:
+            values = [None if pandas.isnull(value) else value for value in series.astype(object)]
+        columns[column] = values
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+
+def position_arrays(rows):
+    import numpy
+    arrays = dict()
+    columns = list(zip(*rows))
+    for i, (name, dtype) in enumerate(POSITION_COLUMNS):
+        values = columns[i] if columns else ()
+        if dtype == 'int64':
+            missing = 0
+        elif dtype == 'datetime64[s]':
+            missing = 'NaT'
+        else:
+            missing = numpy.nan
+        arrays[name] = numpy.array([missing if value is None else value for value in values], dtype=dtype)
+    return arrays
+
+
+def concatenate_arrays(chunks):
+    import numpy
+    chunks = list(chunks)
+    if len(chunks) == 0:
+        return position_arrays([])
+    return {name: numpy.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
 
 
 class Database:
     def commit(self):
         self.connection.commit()
 
+    def rollback(self):
+        self.connection.rollback()
+
+    def executemany(self, query, rows):
+        self.cursor.executemany(query, rows)
+
+    def values_placeholder(self, n_columns):
+        return '(' + ','.join([self.placeholder] * n_columns) + ')'
+
+    def execute_values(self, query, rows, template=None):
+        self.cursor.executemany(query, rows)
+
+    def stream_cursor(self):
+        return self.connection.cursor()
+
+    def get_engine(self):
+        if self.engine is None:
+            import sqlalchemy
+            self.engine = sqlalchemy.create_engine(self.uri)
+        return self.engine
+
     def close(self):
         self.connection.close()
+        if self.engine is not None:
+            self.engine.dispose()
+
+    def reconnect(self):
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+        self.connect()
 
 
 class PostgresDatabase(Database):
-    def __init__(self, config_file, config_name):
+    def __init__(self, config_file, config_name, connect_timeout=10):
+        self.connect_timeout = connect_timeout
         self.user = None
         self.pwd = None
         self.connection = None
@@ -24,10 +94,12 @@ class PostgresDatabase(Database):
         self.host = None
         self.db_name = None
         self.uri = None
+        self.engine = None
         self.load_config(config_file, config_name)
         self.connect()
         self.db_type = 'postgres'
         self.placeholder = '%s'
+        self.row_id = 'idx'
 
     def load_config(self, config_file, config_name):
         config = configparser.ConfigParser(allow_no_value=True)
@@ -41,19 +113,48 @@ class PostgresDatabase(Database):
         self.uri = self.uri.format(user=self.user, pwd=self.pwd, host=self.host, db_name=self.db_name)
 
     def connect(self):
-        connection_str = "host='{}' dbname='{}' user='{}' password='{}'".format(self.host, self.db_name, self.user, self.pwd)
+        connection_str = "host='{}' dbname='{}' user='{}' password='{}' connect_timeout={}".format(
+            self.host, self.db_name, self.user, self.pwd, self.connect_timeout)
+        import psycopg2
+        import psycopg2.extras
         self.connection = psycopg2.connect(connection_str)
         self.cursor = self.connection.cursor()
         self.dict_cursor = self.connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
+    def executemany(self, query, rows):
+        import psycopg2.extras
+        psycopg2.extras.execute_batch(self.cursor, query, rows, page_size=500)
+
+    def values_placeholder(self, n_columns):
+        return '%s'
+
+    def execute_values(self, query, rows, template=None):
+        import psycopg2.extras
+        psycopg2.extras.execute_values(self.cursor, query, rows, template=template, page_size=1000)
+
+    def stream_cursor(self):
+        return self.connection.cursor(name='stream_{}'.format(uuid.uuid4().hex), withhold=True)
+
+    def set_autocommit(self, autocommit):
+        self.connection.autocommit = autocommit
+
+    def copy_expert(self, query, infile):
+        self.cursor.copy_expert(query, infile)
+
 
 class SQLiteDatabase(Database):
     def __init__(self, db_path):
-        self.connection = sqlite3.connect(db_path)
-        self.cursor = self.connection.cursor()
+        self.db_path = db_path
+        self.connect()
         self.uri = 'sqlite:///{db_path}'.format(db_path=db_path)
+        self.engine = None
         self.db_type = 'sqlite'
         self.placeholder = '?'
+        self.row_id = 'rowid'
+
+    def connect(self):
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.cursor = self.connection.cursor()
 
 
 class DBTable:
@@ -71,6 +172,16 @@ class DBTable:
         self.database.cursor.execute(query)
         self.database.commit()
 
+    def exists(self):
+        if self.database.db_type == 'sqlite':
+            query = "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = {val}"
+            name = self.table_name
+        else:
+            query = 'SELECT count(*) FROM pg_class WHERE oid = to_regclass({val})'
+            name = self.full_table_name
+        self.database.cursor.execute(query.format(val=self.database.placeholder), (name,))
+        return self.database.cursor.fetchone()[0] > 0
+
     def drop(self):
         query = 'DROP TABLE IF EXISTS {table_name}'.format(table_name=self.full_table_name)
         query = query.format(table_name=self.full_table_name)
@@ -86,18 +197,71 @@ class DBTable:
         ret = self.database.cursor.fetchall()
         return ret
 
-    def from_dataframe(self, df):
-        engine = sqlalchemy.create_engine(self.database.uri)
-        df.to_sql(name=self.full_table_name, con=engine, schema=self.schema, if_exists='replace', index=True)
+    def from_dataframe(self, df, if_exists='replace', chunksize=10000):
+        if if_exists == 'upsert':
+            for start in range(0, len(df), chunksize):
+                self.upsert_records(dataframe_records(df.iloc[start:start + chunksize]))
+                self.commit()
+            return
+        df.to_sql(name=self.table_name, con=self.database.get_engine(), schema=self.schema, if_exists=if_exists,
+                  index=if_exists == 'replace', chunksize=chunksize, method='multi')
+
+    def upsert_records(self, records):
+        raise NotImplementedError('{} does not support upserts'.format(self.__class__.__name__))
 
     def to_dataframe(self, query=None):
         if query is None:
             query = 'SELECT * FROM {table_name}'
         query = query.format(table_name=self.full_table_name)
-        engine = sqlalchemy.create_engine(self.database.uri)
-        df = pandas.read_sql(sql=query, con=engine)
+        import pandas
+        df = pandas.read_sql(sql=query, con=self.database.get_engine())
         return df
 
+    def iter_dataframes(self, query=None, chunksize=10000):
+        if query is None:
+            query = 'SELECT * FROM {table_name}'
+        query = query.format(table_name=self.full_table_name)
+        import pandas
+        import sqlalchemy
+        with self.database.get_engine().connect() as connection:
+            connection = connection.execution_options(stream_results=True)
+            for df in pandas.read_sql(sql=sqlalchemy.text(query), con=connection, chunksize=chunksize):
+                yield df
+
+    def create_staging(self, staging_name):
+        columns = ','.join('{} text'.format(name) for name, column_type in self.copy_columns)
+        query = 'CREATE TEMPORARY TABLE IF NOT EXISTS {staging_name} (staging_row bigserial, {columns})'
+        self.database.cursor.execute(query.format(staging_name=staging_name, columns=columns))
+        self.database.cursor.execute('TRUNCATE {staging_name}'.format(staging_name=staging_name))
+
+    def derived_columns(self):
+        return []
+
+    def merge_staging(self, staging_name):
+        names = [name for name, column_type in self.copy_columns]
+        selects = list(names)
+        update_set = self.update_set
+        for name, expression in self.derived_columns():
+            names.append(name)
+            selects.append(expression)
+            update_set += ',{name}=excluded.{name}'.format(name=name)
+        casts = ','.join(self.staging_cast(name, column_type) for name, column_type in self.copy_columns)
+        query = 'INSERT INTO {table_name} ({names}) ' \
+                'SELECT {selects} FROM (' \
+                'SELECT DISTINCT ON ({key}) * FROM (SELECT staging_row, {casts} FROM {staging_name}) AS typed ' \
+                'WHERE {row_filter} ORDER BY {key}, staging_row DESC) AS latest ' \
+                'ON CONFLICT {conflict} DO UPDATE SET {update_set}'
+        for conflict, row_filter, key in self.merge_targets:
+            self.database.cursor.execute(query.format(table_name=self.full_table_name, names=','.join(names),
+                                                      selects=','.join(selects), key=key, casts=casts,
+                                                      staging_name=staging_name, row_filter=row_filter,
+                                                      conflict=conflict, update_set=update_set))
+
+    def staging_cast(self, name, column_type):
+        if column_type == 'integer':
+            return 'NULLIF({name}, \'\')::numeric::integer AS {name}'.format(name=name)
+        return 'NULLIF({name}, \'\')::{column_type} AS {name}'.format(name=name, column_type=column_type)
+
     def add_pkey(self):
         query = 'ALTER TABLE {full_table_name} ADD CONSTRAINT {table_name}_pkey PRIMARY KEY(idx);'
         query = query.format(full_table_name=self.full_table_name, table_name=self.table_name)
@@ -105,14 +269,58 @@ class DBTable:
         self.database.commit()
 
 
+class MigrationTable(DBTable):
+    table_name = 'schema_migrations'
+
+    def create(self):
+        query = 'CREATE TABLE IF NOT EXISTS {table_name} (' \
+                'name text PRIMARY KEY,' \
+                'applied_at text)'
+        query = query.format(table_name=self.full_table_name)
+        self.database.cursor.execute(query)
+        self.database.commit()
+
+    def applied(self):
+        query = 'SELECT name FROM {table_name}'.format(table_name=self.full_table_name)
+        self.database.cursor.execute(query)
+        return set(row[0] for row in self.database.cursor.fetchall())
+
+    def migrate(self, tables):
+        self.create()
+        applied = self.applied()
+        for table in tables:
+            if not table.exists():
+                print('Creating table {}'.format(table.full_table_name))
+                table.create()
+            for name, migration in table.migrations():
+                name = '{}.{}'.format(table.full_table_name, name)
+                if name in applied:
+                    continue
+                print('Applying migration {}'.format(name))
+                try:
+                    migration()
+                    query = 'INSERT INTO {table_name} (name, applied_at) VALUES ({val},{val})'
+                    query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+                    self.database.cursor.execute(query, (name, datetime.datetime.utcnow().isoformat()))
+                    self.database.commit()
+                except Exception:
+                    self.database.rollback()
+                    raise
+
+
 class VesselTable(DBTable):
     table_name = 'vessels'
+    copy_columns = [('mmsi', 'integer'), ('imo', 'integer'), ('name', 'text'), ('country', 'text'),
+                    ('ship_type', 'text'), ('gt', 'double precision'), ('built', 'integer'), ('length', 'integer'),
+                    ('width', 'integer')]
+    merge_targets = [('(mmsi) WHERE mmsi IS NOT NULL', 'mmsi IS NOT NULL', 'mmsi'),
+                     ('(imo) WHERE mmsi IS NULL AND imo IS NOT NULL', 'mmsi IS NULL AND imo IS NOT NULL', 'imo')]
+    update_set = 'mmsi=excluded.mmsi,imo=excluded.imo,name=excluded.name,country=excluded.country,' \
+                 'ship_type=excluded.ship_type,gt=excluded.gt,built=excluded.built,length=excluded.length,' \
+                 'width=excluded.width'
 
     def upsert_vessel(self, ship_info):
-        if self.already_exists(ship_info):
-            self.update_vessel(ship_info)
-        else:
-            self.insert(ship_info)
+        self.upsert_vessels([ship_info])
 
     def already_exists(self, ship_info):
         if ship_info['imo'] is not None:
@@ -129,6 +337,32 @@ class VesselTable(DBTable):
         else:
             return False
 
+    def upsert_vessels(self, ship_infos):
+        ship_infos = list({self.vessel_key(s): s for s in ship_infos}.values())
+        by_mmsi = [s for s in ship_infos if s['mmsi'] is not None]
+        by_imo = [s for s in ship_infos if s['mmsi'] is None]
+        query = 'INSERT INTO {table_name} (mmsi, imo, name, country, ship_type, gt, built, length, width) ' \
+                'VALUES {values} ' \
+                'ON CONFLICT {conflict} DO UPDATE SET {update_set}'
+        for (conflict, row_filter, key), batch in zip(self.merge_targets, [by_mmsi, by_imo]):
+            if len(batch) == 0:
+                continue
+            rows = [(s['mmsi'], s['imo'], s['name'], s['country'], s['ship_type'], s['gt'], s['built'],
+                     s['length'], s['width']) for s in batch]
+            self.database.execute_values(query.format(table_name=self.full_table_name, conflict=conflict,
+                                                      update_set=self.update_set,
+                                                      values=self.database.values_placeholder(9)), rows)
+
+    def upsert_records(self, records):
+        self.upsert_vessels(records)
+
+    def vessel_key(self, ship_info):
+        if ship_info['mmsi'] is not None:
+            return 'mmsi', ship_info['mmsi']
+        if ship_info['imo'] is not None:
+            return 'imo', ship_info['imo']
+        return 'url', ship_info.get('url')
+
     def delete_vessel(self, ship_info):
         if ship_info['mmsi']:
             mmsi = ship_info['mmsi']
@@ -204,11 +438,32 @@ class VesselTable(DBTable):
         imo = ship_info['imo']
         self.database.cursor.execute(query, (mmsi, name, country, ship_type, gt, built, length, width, imo))
 
+    def migrations(self):
+        return [('natural_keys', self.add_natural_keys)]
+
+    def add_natural_keys(self):
+        query = 'DELETE FROM {table_name} WHERE {column} IS NOT NULL AND {filter} AND {row_id} NOT IN (' \
+                'SELECT max({row_id}) FROM {table_name} WHERE {column} IS NOT NULL AND {filter} GROUP BY {column})'
+        for column, row_filter in [('mmsi', 'TRUE'), ('imo', 'mmsi IS NULL')]:
+            self.database.cursor.execute(query.format(table_name=self.full_table_name, column=column,
+                                                      filter=row_filter, row_id=self.database.row_id))
+        self.create_keys()
+
+    def create_keys(self):
+        queries = ['CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_mmsi_key ON {full_table_name} (mmsi) '
+                   'WHERE mmsi IS NOT NULL',
+                   'CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_imo_key ON {full_table_name} (imo) '
+                   'WHERE mmsi IS NULL AND imo IS NOT NULL',
+                   'CREATE INDEX IF NOT EXISTS {table_name}_imo_idx ON {full_table_name} (imo)']
+        for query in queries:
+            query = query.format(table_name=self.table_name, full_table_name=self.full_table_name)
+            self.database.cursor.execute(query)
+
     def batch_insert(self, ret):
         query = 'INSERT INTO {table_name}(idx, mmsi, imo, name, ship_type, gt, built, length, width, country)'\
-                'VALUES {val}'
-        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
-        psycopg2.extras.execute_values(self.database.cursor, query, ret)
+                'VALUES {values}'
+        query = query.format(table_name=self.full_table_name, values=self.database.values_placeholder(10))
+        self.database.execute_values(query, ret)
 
     def create(self):
         query = 'CREATE TABLE {table_name}(' \
@@ -224,15 +479,66 @@ class VesselTable(DBTable):
                 'country text)'
         query = query.format(table_name=self.full_table_name)
         self.database.cursor.execute(query)
+        self.create_keys()
         self.database.commit()
 
 
 class PositionTable(DBTable):
     table_name = 'positions'
+    copy_columns = [('mmsi', 'integer'), ('imo', 'integer'), ('date', 'timestamp without time zone'),
+                    ('latitude', 'double precision'), ('longitude', 'double precision'), ('speed', 'double precision')]
+    merge_targets = [('(mmsi, date) WHERE mmsi IS NOT NULL', 'mmsi IS NOT NULL', 'mmsi, date'),
+                     ('(imo, date) WHERE mmsi IS NULL', 'mmsi IS NULL', 'imo, date')]
+    update_set = 'imo=excluded.imo,latitude=excluded.latitude,longitude=excluded.longitude,speed=excluded.speed'
+    geometry_expression = 'ST_SetSRID(ST_MakePoint({longitude}, {latitude}), 4326)'
+
+    def __init__(self, database, schema=None, geometry=None):
+        super(PositionTable, self).__init__(database, schema)
+        if geometry is None:
+            geometry = database.db_type == 'postgres'
+        self.geometry = geometry
+
+    def derived_columns(self):
+        if not self.geometry:
+            return []
+        return [('geom', self.geometry_expression.format(longitude='longitude', latitude='latitude'))]
 
     def upsert_position(self, position_info):
-        self.delete_position(position_info)
-        self.add_position(position_info)
+        self.upsert_positions([position_info])
+
+    def upsert_positions(self, position_infos):
+        position_infos = list({self.position_key(p): p for p in position_infos}.values())
+        by_mmsi = [p for p in position_infos if p['mmsi'] is not None]
+        by_imo = [p for p in position_infos if p['mmsi'] is None]
+        query = 'INSERT INTO {table_name} (mmsi, imo, date, latitude, longitude, speed{geom_column}) ' \
+                'VALUES {values} ' \
+                'ON CONFLICT {conflict} DO UPDATE SET {update_set}'
+        geom_column = ''
+        update_set = self.update_set
+        template = None
+        if self.geometry:
+            geom_column = ', geom'
+            update_set += ',geom=excluded.geom'
+            val = self.database.placeholder
+            template = '({val},{val},{val},{val},{val},{val},{geom})'.format(
+                val=val, geom=self.geometry_expression.format(longitude=val, latitude=val))
+        for (conflict, row_filter, key), batch in zip(self.merge_targets, [by_mmsi, by_imo]):
+            if len(batch) == 0:
+                continue
+            rows = [(p['mmsi'], p['imo'], p['date'], p['latitude'], p['longitude'], p['speed']) for p in batch]
+            if self.geometry:
+                rows = [row + (row[4], row[3]) for row in rows]
+            self.database.execute_values(query.format(table_name=self.full_table_name, geom_column=geom_column,
+                                                      conflict=conflict, update_set=update_set,
+                                                      values=self.database.values_placeholder(6)), rows, template)
+
+    def upsert_records(self, records):
+        self.upsert_positions(records)
+
+    def position_key(self, position_info):
+        if position_info['mmsi'] is not None:
+            return 'mmsi', position_info['mmsi'], position_info['date']
+        return 'imo', position_info['imo'], position_info['date']
 
     def delete_position(self, position_info):
         mmsi = position_info['mmsi']
@@ -275,25 +581,210 @@ class PositionTable(DBTable):
         speed = position_info['speed']
         self.database.cursor.execute(query, (mmsi, imo, date, latitude, longitude, speed))
 
+    def migrations(self):
+        migrations = [('natural_keys', self.add_natural_keys)]
+        if self.geometry:
+            migrations.append(('geometry_backfill_index', self.add_geometry_backfill_index))
+        if self.database.db_type == 'sqlite':
+            migrations.append(('spatial_index', self.create_spatial_index))
+        return migrations
+
+    def add_natural_keys(self):
+        query = 'DELETE FROM {table_name} WHERE {column} IS NOT NULL AND {filter} AND {row_id} NOT IN (' \
+                'SELECT max({row_id}) FROM {table_name} WHERE {column} IS NOT NULL AND {filter} ' \
+                'GROUP BY {column}, date)'
+        for column, row_filter in [('mmsi', 'TRUE'), ('imo', 'mmsi IS NULL')]:
+            self.database.cursor.execute(query.format(table_name=self.full_table_name, column=column,
+                                                      filter=row_filter, row_id=self.database.row_id))
+        self.create_keys()
+
+    def create_keys(self):
+        queries = ['CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_mmsi_date_key ON {full_table_name} (mmsi, date) '
+                   'WHERE mmsi IS NOT NULL',
+                   'CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_imo_date_key ON {full_table_name} (imo, date) '
+                   'WHERE mmsi IS NULL',
+                   'CREATE INDEX IF NOT EXISTS {table_name}_date_idx ON {full_table_name} (date)']
+        for query in queries:
+            query = query.format(table_name=self.table_name, full_table_name=self.full_table_name)
+            self.database.cursor.execute(query)
+
     def batch_insert(self, ret):
         query = 'INSERT INTO {table_name} (idx, mmsi, imo, date, latitude, longitude, speed) ' \
-                'VALUES {val}'
-        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
-        psycopg2.extras.execute_values(self.database.cursor, query, ret)
+                'VALUES {values}'
+        query = query.format(table_name=self.full_table_name, values=self.database.values_placeholder(7))
+        self.database.execute_values(query, ret)
 
-    def make_geometries_index(self):
-        query = 'CREATE INDEX ON {table_name} USING gist(geom);'
-        query = query.format(table_name=self.full_table_name)
-        self.database.cursor.execute(query)
+    def make_geometries_index(self, concurrently=True):
+        query = 'CREATE INDEX {concurrently} IF NOT EXISTS {table_name}_geom_idx ON {full_table_name} USING gist(geom);'
+        query = query.format(concurrently='CONCURRENTLY' if concurrently else '', table_name=self.table_name,
+                             full_table_name=self.full_table_name)
+        if not concurrently:
+            self.database.cursor.execute(query)
+            self.database.commit()
+            return
         self.database.commit()
+        self.database.set_autocommit(True)
+        try:
+            self.database.cursor.execute(query)
+        finally:
+            self.database.set_autocommit(False)
 
     def make_geometries(self):
-        query = 'UPDATE {table_name} SET geom = ST_SetSRID(ST_MakePoint(longitude, latitude), 4326) \
-                WHERE geom IS NULL \
-                AND latitude IS NOT NULL;'
-        query = query.format(table_name=self.full_table_name)
+        self.backfill_geometries()
+
+    def backfill_geometries(self, batch_size=10000, progress=print):
+        query = 'UPDATE {table_name} SET geom = {geometry} ' \
+                'WHERE geom IS NULL AND latitude IS NOT NULL AND idx IN (' \
+                'SELECT idx FROM {table_name} ' \
+                'WHERE idx > {val} AND geom IS NULL AND latitude IS NOT NULL ' \
+                'ORDER BY idx LIMIT {val}) ' \
+                'RETURNING idx'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder,
+                             geometry=self.geometry_expression.format(longitude='longitude', latitude='latitude'))
+        last_idx = 0
+        updated = 0
+        start = time.perf_counter()
+        while True:
+            self.database.cursor.execute(query, (last_idx, batch_size))
+            ret = self.database.cursor.fetchall()
+            self.database.commit()
+            if len(ret) == 0:
+                break
+            last_idx = max(row[0] for row in ret)
+            updated += len(ret)
+            if progress is not None:
+                progress('geometries: {} rows updated, up to idx {} ({:.0f} rows/sec)'.format(
+                    updated, last_idx, updated / (time.perf_counter() - start)))
+        return updated
+
+    def add_geometry_backfill_index(self):
+        query = 'CREATE INDEX IF NOT EXISTS {table_name}_geom_null_idx ON {full_table_name} (idx) ' \
+                'WHERE geom IS NULL AND latitude IS NOT NULL'
+        query = query.format(table_name=self.table_name, full_table_name=self.full_table_name)
         self.database.cursor.execute(query)
-        self.database.commit()
+
+    def create_spatial_index(self):
+        queries = ['CREATE VIRTUAL TABLE IF NOT EXISTS {rtree_name} USING rtree(id, min_lon, max_lon, min_lat, max_lat)',
+                   'CREATE TRIGGER IF NOT EXISTS {table_name}_rtree_insert AFTER INSERT ON {full_table_name} '
+                   'BEGIN {rtree_insert}; END',
+                   'CREATE TRIGGER IF NOT EXISTS {table_name}_rtree_update '
+                   'AFTER UPDATE OF latitude, longitude ON {full_table_name} '
+                   'BEGIN DELETE FROM {rtree_name} WHERE id = OLD.{row_id}; {rtree_insert}; END',
+                   'CREATE TRIGGER IF NOT EXISTS {table_name}_rtree_delete AFTER DELETE ON {full_table_name} '
+                   'BEGIN DELETE FROM {rtree_name} WHERE id = OLD.{row_id}; END',
+                   'INSERT OR REPLACE INTO {rtree_name} '
+                   'SELECT {row_id}, longitude, longitude, latitude, latitude FROM {full_table_name} '
+                   'WHERE latitude IS NOT NULL AND longitude IS NOT NULL']
+        rtree_insert = 'INSERT OR REPLACE INTO {rtree_name} ' \
+                       'SELECT NEW.{row_id}, NEW.longitude, NEW.longitude, NEW.latitude, NEW.latitude ' \
+                       'WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL'
+        names = dict(table_name=self.table_name, full_table_name=self.full_table_name,
+                     rtree_name=self.full_table_name + '_rtree', row_id=self.database.row_id)
+        names['rtree_insert'] = rtree_insert.format(**names)
+        for query in queries:
+            self.database.cursor.execute(query.format(**names))
+
+    def drop(self):
+        if self.database.db_type == 'sqlite':
+            self.database.cursor.execute('DROP TABLE IF EXISTS {}_rtree'.format(self.full_table_name))
+        super(PositionTable, self).drop()
+
+    def time_filter(self, start, end, column='date'):
+        conditions = []
+        args = []
+        if start is not None:
+            conditions.append('{column} >= {val}')
+            args.append(start)
+        if end is not None:
+            conditions.append('{column} < {val}')
+            args.append(end)
+        conditions = [condition.format(column=column, val=self.database.placeholder) for condition in conditions]
+        return conditions, args
+
+    def iter_position_arrays(self, query, args, chunksize=10000):
+        cursor = self.database.stream_cursor()
+        try:
+            cursor.execute(query, args)
+            while True:
+                rows = cursor.fetchmany(chunksize)
+                if len(rows) == 0:
+                    break
+                yield position_arrays(rows)
+        finally:
+            cursor.close()
+
+    def positions_in_bbox(self, min_lon, min_lat, max_lon, max_lat, start=None, end=None, chunksize=10000):
+        val = self.database.placeholder
+        columns = 'p.mmsi, p.imo, p.date, p.latitude, p.longitude, p.speed'
+        conditions = ['p.longitude >= {val} AND p.longitude <= {val} AND p.latitude >= {val} AND p.latitude <= {val}']
+        args = [min_lon, max_lon, min_lat, max_lat]
+        if self.database.db_type == 'sqlite':
+            query = 'SELECT {columns} FROM {rtree_name} r CROSS JOIN {table_name} p ON p.{row_id} = r.id WHERE '
+            conditions.insert(0, 'r.max_lon >= {val} AND r.min_lon <= {val} AND r.max_lat >= {val} AND r.min_lat <= {val}')
+            args = [min_lon, max_lon, min_lat, max_lat] + args
+        elif self.geometry:
+            query = 'SELECT {columns} FROM {table_name} p WHERE '
+            conditions.insert(0, 'p.geom && ST_MakeEnvelope({val}, {val}, {val}, {val}, 4326)')
+            args = [min_lon, min_lat, max_lon, max_lat] + args
+        else:
+            query = 'SELECT {columns} FROM {table_name} p WHERE '
+        time_conditions, time_args = self.time_filter(start, end, column='p.date')
+        query += ' AND '.join(conditions + time_conditions)
+        query = query.format(columns=columns, table_name=self.full_table_name, rtree_name=self.full_table_name + '_rtree',
+                             row_id=self.database.row_id, val=val)
+        return self.iter_position_arrays(query, args + time_args, chunksize)
+
+    def track(self, mmsi=None, imo=None, start=None, end=None):
+        if mmsi is not None:
+            conditions = ['mmsi = {val}']
+            args = [mmsi]
+        else:
+            conditions = ['mmsi IS NULL', 'imo = {val}']
+            args = [imo]
+        time_conditions, time_args = self.time_filter(start, end)
+        query = 'SELECT mmsi, imo, date, latitude, longitude, speed FROM {table_name} WHERE {conditions} ORDER BY date'
+        query = query.format(table_name=self.full_table_name, conditions=' AND '.join(conditions + time_conditions))
+        query = query.format(val=self.database.placeholder)
+        return concatenate_arrays(self.iter_position_arrays(query, args + time_args))
+
+    def nearest(self, longitude, latitude, k=10, start=None, end=None, radius=0.1, candidates=10):
+        import numpy
+        from geo import KM_PER_DEGREE
+        if self.geometry and self.database.db_type == 'postgres':
+            time_conditions, time_args = self.time_filter(start, end)
+            query = 'SELECT mmsi, imo, date, latitude, longitude, speed FROM {table_name} ' \
+                    'WHERE {conditions} ' \
+                    'ORDER BY geom <-> ST_SetSRID(ST_MakePoint({val}, {val}), 4326) LIMIT {val}'
+            query = query.format(table_name=self.full_table_name, val=self.database.placeholder,
+                                 conditions=' AND '.join(['geom IS NOT NULL'] + time_conditions))
+            limit = k * candidates
+            while True:
+                arrays = concatenate_arrays(self.iter_position_arrays(query, time_args + [longitude, latitude, limit]))
+                nearest = self.nearest_vessels(arrays, longitude, latitude, k)
+                if len(nearest['distance_km']) >= k or len(arrays['mmsi']) < limit:
+                    return nearest
+                limit *= 4
+        while True:
+            arrays = concatenate_arrays(self.positions_in_bbox(longitude - radius, latitude - radius,
+                                                               longitude + radius, latitude + radius, start, end))
+            nearest = self.nearest_vessels(arrays, longitude, latitude, k)
+            inscribed_km = radius * KM_PER_DEGREE * numpy.cos(numpy.radians(min(90.0, abs(latitude) + radius)))
+            found_all = len(nearest['distance_km']) >= k and nearest['distance_km'][-1] <= inscribed_km
+            if found_all or radius >= 180:
+                return nearest
+            radius *= 4
+
+    def nearest_vessels(self, arrays, longitude, latitude, k):
+        import numpy
+        from geo import haversine_km
+        distance = haversine_km(latitude, longitude, arrays['latitude'], arrays['longitude'])
+        order = numpy.argsort(distance, kind='stable')
+        vessel = numpy.where(arrays['mmsi'][order] != 0, arrays['mmsi'][order], -arrays['imo'][order])
+        unique, first = numpy.unique(vessel, return_index=True)
+        order = order[numpy.sort(first)][:k]
+        nearest = {name: values[order] for name, values in arrays.items()}
+        nearest['distance_km'] = distance[order]
+        return nearest
 
     def create(self):
         query = 'CREATE TABLE {table_name} (' \
@@ -307,4 +798,301 @@ class PositionTable(DBTable):
                 'geom geometry);'
         query = query.format(table_name=self.full_table_name)
         self.database.cursor.execute(query)
+        self.create_keys()
+        if self.database.db_type == 'sqlite':
+            self.create_spatial_index()
+        self.database.commit()
+
+
+class ChangeCacheTable(DBTable):
+    table_name = 'change_cache'
+
+    def upsert_entries(self, entries):
+        if len(entries) == 0:
+            return
+        query = 'INSERT INTO {table_name} (vessel_key, date, vessel_hash) ' \
+                'VALUES {values} ' \
+                'ON CONFLICT (vessel_key) DO UPDATE SET date=excluded.date, vessel_hash=excluded.vessel_hash'
+        query = query.format(table_name=self.full_table_name, values=self.database.values_placeholder(3))
+        self.database.execute_values(query, entries)
+
+    def create(self):
+        query = 'CREATE TABLE IF NOT EXISTS {table_name} (' \
+                'vessel_key text PRIMARY KEY,' \
+                'date text,' \
+                'vessel_hash text)'
+        query = query.format(table_name=self.full_table_name)
+        self.database.cursor.execute(query)
+        self.database.commit()
+
+
+class PageIndexTable(DBTable):
+    table_name = 'pages'
+
+    def add_page(self, url, fetched_at, sha256, size):
+        query = 'INSERT INTO {table_name} (url, fetched_at, sha256, size) ' \
+                'VALUES ({val},{val},{val},{val}) ' \
+                'ON CONFLICT (url, fetched_at) DO NOTHING'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.cursor.execute(query, (url, fetched_at, sha256, size))
+
+    def select_pages(self, since=None, until=None):
+        query = 'SELECT url, fetched_at, sha256 FROM {table_name} ' \
+                'WHERE fetched_at >= {val} AND fetched_at < {val} ' \
+                'ORDER BY fetched_at'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        if since is None:
+            since = datetime.datetime.min
+        if until is None:
+            until = datetime.datetime.max
+        cursor = self.database.connection.cursor()
+        cursor.execute(query, (since, until))
+        while True:
+            rows = cursor.fetchmany(1000)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield row
+
+    def create(self):
+        queries = ['CREATE TABLE IF NOT EXISTS {full_table_name} ('
+                   'url text,'
+                   'fetched_at timestamp without time zone,'
+                   'sha256 text,'
+                   'size integer,'
+                   'PRIMARY KEY (url, fetched_at))',
+                   'CREATE INDEX IF NOT EXISTS {table_name}_fetched_at_idx ON {full_table_name} (fetched_at)',
+                   'CREATE INDEX IF NOT EXISTS {table_name}_sha256_idx ON {full_table_name} (sha256)']
+        for query in queries:
+            query = query.format(table_name=self.table_name, full_table_name=self.full_table_name)
+            self.database.cursor.execute(query)
+        self.database.commit()
+
+
+class FrontierTable(DBTable):
+    table_name = 'frontier'
+
+    def add_urls(self, rows):
+        if len(rows) == 0:
+            return
+        query = 'INSERT INTO {table_name} (vessel_key, url, priority, added_at, admitted) ' \
+                'VALUES {values} ' \
+                'ON CONFLICT (vessel_key) DO UPDATE SET ' \
+                'priority=CASE WHEN excluded.priority > {table_name}.priority ' \
+                'THEN excluded.priority ELSE {table_name}.priority END'
+        query = query.format(table_name=self.full_table_name, values=self.database.values_placeholder(5))
+        self.database.execute_values(query, rows)
+
+    def pending(self, limit):
+        query = 'SELECT vessel_key, url FROM {table_name} WHERE admitted = 0 ' \
+                'ORDER BY priority DESC, added_at LIMIT {val}'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.cursor.execute(query, (limit,))
+        return self.database.cursor.fetchall()
+
+    def mark_admitted(self, vessel_keys):
+        query = 'UPDATE {table_name} SET admitted = 1 WHERE vessel_key = {val}'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.executemany(query, [(vessel_key,) for vessel_key in vessel_keys])
+
+    def count(self, admitted=None):
+        query = 'SELECT COUNT(*) FROM {table_name}'
+        args = ()
+        if admitted is not None:
+            query += ' WHERE admitted = {val}'
+            args = (int(admitted),)
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.cursor.execute(query, args)
+        return self.database.cursor.fetchone()[0]
+
+    def create(self):
+        queries = ['CREATE TABLE IF NOT EXISTS {full_table_name} ('
+                   'vessel_key text PRIMARY KEY,'
+                   'url text,'
+                   'priority real,'
+                   'added_at text,'
+                   'admitted integer)',
+                   'CREATE INDEX IF NOT EXISTS {table_name}_pending_idx '
+                   'ON {full_table_name} (admitted, priority DESC, added_at)']
+        for query in queries:
+            query = query.format(table_name=self.table_name, full_table_name=self.full_table_name)
+            self.database.cursor.execute(query)
+        self.database.commit()
+
+
+class ScheduleTable(DBTable):
+    table_name = 'schedule'
+
+    def add_urls(self, rows):
+        if len(rows) == 0:
+            return
+        query = 'INSERT INTO {table_name} (url, due_at, poll_interval, speed, report_date, errors) ' \
+                'VALUES {values} ' \
+                'ON CONFLICT (url) DO NOTHING'
+        query = query.format(table_name=self.full_table_name, values=self.database.values_placeholder(6))
+        self.database.execute_values(query, rows)
+
+    def due(self, now, limit):
+        query = 'SELECT url, poll_interval FROM {table_name} WHERE due_at <= {val} ORDER BY due_at LIMIT {val}'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.cursor.execute(query, (now, limit))
+        return self.database.cursor.fetchall()
+
+    def reschedule(self, rows):
+        query = 'UPDATE {table_name} SET due_at = {val} WHERE url = {val}'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.executemany(query, rows)
+
+    def entry(self, url):
+        query = 'SELECT speed, report_date, errors FROM {table_name} WHERE url = {val}'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.cursor.execute(query, (url,))
+        return self.database.cursor.fetchone()
+
+    def update_entry(self, url, due_at, poll_interval, speed, report_date, errors):
+        query = 'UPDATE {table_name} ' \
+                'SET due_at={val},poll_interval={val},speed={val},report_date={val},errors={val} ' \
+                'WHERE url = {val}'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.cursor.execute(query, (due_at, poll_interval, speed, report_date, errors, url))
+
+    def next_due(self):
+        query = 'SELECT MIN(due_at) FROM {table_name}'.format(table_name=self.full_table_name)
+        self.database.cursor.execute(query)
+        return self.database.cursor.fetchone()[0]
+
+    def count(self):
+        query = 'SELECT COUNT(*) FROM {table_name}'.format(table_name=self.full_table_name)
+        self.database.cursor.execute(query)
+        return self.database.cursor.fetchone()[0]
+
+    def create(self):
+        queries = ['CREATE TABLE IF NOT EXISTS {full_table_name} ('
+                   'url text PRIMARY KEY,'
+                   'due_at double precision,'
+                   'poll_interval double precision,'
+                   'speed double precision,'
+                   'report_date text,'
+                   'errors integer)',
+                   'CREATE INDEX IF NOT EXISTS {table_name}_due_idx ON {full_table_name} (due_at)']
+        for query in queries:
+            query = query.format(table_name=self.table_name, full_table_name=self.full_table_name)
+            self.database.cursor.execute(query)
+        self.database.commit()
+
+
+class WorkQueueTable(DBTable):
+    table_name = 'work_queue'
+
+    def enqueue(self, rows):
+        if len(rows) == 0:
+            return
+        query = 'INSERT INTO {table_name} (vessel_key, url, shard, due_at, poll_interval, attempts) ' \
+                'VALUES {values} ' \
+                'ON CONFLICT (vessel_key) DO NOTHING'
+        query = query.format(table_name=self.full_table_name, values=self.database.values_placeholder(6))
+        self.database.execute_values(query, rows)
+
+    def shard_filter(self, shards):
+        return 'shard IN ({})'.format(','.join([self.database.placeholder] * len(shards)))
+
+    def claim(self, worker_id, shards, now, lease_expires, limit):
+        if len(shards) == 0:
+            return []
+        lock = ''
+        if self.database.db_type == 'postgres':
+            lock = ' FOR UPDATE SKIP LOCKED'
+        query = 'UPDATE {table_name} SET lease_owner = {val}, lease_expires = {val} ' \
+                'WHERE vessel_key IN (' \
+                'SELECT vessel_key FROM {table_name} ' \
+                'WHERE {shard_filter} AND due_at <= {val} AND (lease_expires IS NULL OR lease_expires < {val}) ' \
+                'ORDER BY due_at LIMIT {val}{lock}) ' \
+                'RETURNING vessel_key, url, poll_interval, attempts'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder,
+                             shard_filter=self.shard_filter(shards), lock=lock)
+        if self.database.db_type == 'sqlite':
+            self.database.commit()
+            self.database.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            self.database.cursor.execute(query, [worker_id, lease_expires] + list(shards) + [now, now, limit])
+            rows = self.database.cursor.fetchall()
+            self.database.commit()
+        except Exception:
+            self.database.rollback()
+            raise
+        return rows
+
+    def release(self, vessel_key, worker_id, due_at, poll_interval, attempts):
+        query = 'UPDATE {table_name} ' \
+                'SET due_at = {val}, poll_interval = {val}, attempts = {val}, ' \
+                'lease_owner = NULL, lease_expires = NULL ' \
+                'WHERE vessel_key = {val} AND lease_owner = {val}'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.cursor.execute(query, (due_at, poll_interval, attempts, vessel_key, worker_id))
+
+    def extend_leases(self, worker_id, lease_expires):
+        query = 'UPDATE {table_name} SET lease_expires = {val} WHERE lease_owner = {val}'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.cursor.execute(query, (lease_expires, worker_id))
+
+    def release_all(self, worker_id):
+        query = 'UPDATE {table_name} SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = {val}'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.cursor.execute(query, (worker_id,))
+
+    def next_due(self, shards):
+        if len(shards) == 0:
+            return None
+        query = 'SELECT MIN(due_at) FROM {table_name} WHERE {shard_filter} AND lease_owner IS NULL'
+        query = query.format(table_name=self.full_table_name, shard_filter=self.shard_filter(shards))
+        self.database.cursor.execute(query, list(shards))
+        return self.database.cursor.fetchone()[0]
+
+    def create(self):
+        queries = ['CREATE TABLE IF NOT EXISTS {full_table_name} ('
+                   'vessel_key text PRIMARY KEY,'
+                   'url text,'
+                   'shard integer,'
+                   'due_at double precision,'
+                   'poll_interval double precision,'
+                   'attempts integer,'
+                   'lease_owner text,'
+                   'lease_expires double precision)',
+                   'CREATE INDEX IF NOT EXISTS {table_name}_due_idx ON {full_table_name} (shard, due_at)',
+                   'CREATE INDEX IF NOT EXISTS {table_name}_owner_idx ON {full_table_name} (lease_owner)']
+        for query in queries:
+            query = query.format(table_name=self.table_name, full_table_name=self.full_table_name)
+            self.database.cursor.execute(query)
+        self.database.commit()
+
+
+class WorkerTable(DBTable):
+    table_name = 'crawl_workers'
+
+    def heartbeat(self, worker_id, host, now):
+        query = 'INSERT INTO {table_name} (worker_id, host, started_at, last_heartbeat) ' \
+                'VALUES ({val},{val},{val},{val}) ' \
+                'ON CONFLICT (worker_id) DO UPDATE SET last_heartbeat=excluded.last_heartbeat'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.cursor.execute(query, (worker_id, host, now, now))
+
+    def live_workers(self, since):
+        query = 'SELECT worker_id FROM {table_name} WHERE last_heartbeat >= {val}'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.cursor.execute(query, (since,))
+        return [row[0] for row in self.database.cursor.fetchall()]
+
+    def remove(self, worker_id):
+        query = 'DELETE FROM {table_name} WHERE worker_id = {val}'
+        query = query.format(table_name=self.full_table_name, val=self.database.placeholder)
+        self.database.cursor.execute(query, (worker_id,))
+
+    def create(self):
+        query = 'CREATE TABLE IF NOT EXISTS {table_name} (' \
+                'worker_id text PRIMARY KEY,' \
+                'host text,' \
+                'started_at double precision,' \
+                'last_heartbeat double precision)'
+        query = query.format(table_name=self.full_table_name)
+        self.database.cursor.execute(query)
         self.database.commit()
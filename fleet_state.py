@@ -0,0 +1,165 @@
+import datetime
+import os
+import pickle
+import sys
+import threading
+
+import numpy
+
+from sinks import Sink
+
+EPOCH = datetime.datetime(1970, 1, 1)
+POSITION_FIELDS = [('mmsi', numpy.int64), ('imo', numpy.int64), ('epoch', numpy.int64),
+                   ('latitude', numpy.float32), ('longitude', numpy.float32), ('speed', numpy.float32)]
+
+
+class VesselInfo:
+    __slots__ = ('name', 'ship_type', 'country', 'built', 'length', 'width', 'gt')
+
+    interned = ('ship_type', 'country')
+
+    def __init__(self, vessel_params):
+        for name in self.__slots__:
+            setattr(self, name, vessel_params.get(name))
+        for name in self.interned:
+            value = getattr(self, name)
+            if isinstance(value, str):
+                setattr(self, name, sys.intern(value))
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            if name in self.interned and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(self, name, value)
+
+
+def fleet_key(mmsi, imo):
+    if mmsi:
+        return int(mmsi)
+    if imo:
+        return -int(imo)
+    return None
+
+
+class FleetState(Sink):
+    def __init__(self, path=None, capacity=1024):
+        self.path = path
+        self.lock = threading.Lock()
+        self.size = 0
+        self.index = dict()
+        self.info = []
+        for name, dtype in POSITION_FIELDS:
+            setattr(self, name, numpy.zeros(capacity, dtype=dtype))
+        if self.path is not None and os.path.exists(os.path.join(self.path, 'info.pkl')):
+            self.restore()
+
+    def capacity(self):
+        return len(self.mmsi)
+
+    def grow(self, capacity):
+        for name, dtype in POSITION_FIELDS:
+            values = numpy.zeros(capacity, dtype=dtype)
+            values[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, values)
+
+    def row(self, mmsi, imo):
+        key = fleet_key(mmsi, imo)
+        if key is None:
+            return None
+        row = self.index.get(key)
+        if row is None:
+            if self.size == self.capacity():
+                self.grow(2 * self.capacity())
+            row = self.size
+            self.size += 1
+            self.index[key] = row
+            self.info.append(None)
+            self.mmsi[row] = mmsi or 0
+            self.imo[row] = imo or 0
+            self.epoch[row] = -1
+        return row
+
+    def update(self, vessel_params, position=True, vessel=True):
+        row = self.row(vessel_params['mmsi'], vessel_params['imo'])
+        if row is None:
+            return
+        if vessel:
+            self.info[row] = VesselInfo(vessel_params)
+        date = vessel_params['date']
+        if not position or date is None:
+            return
+        epoch = int((date - EPOCH).total_seconds())
+        if epoch < self.epoch[row]:
+            return
+        self.epoch[row] = epoch
+        self.latitude[row] = numpy.nan if vessel_params['latitude'] is None else vessel_params['latitude']
+        self.longitude[row] = numpy.nan if vessel_params['longitude'] is None else vessel_params['longitude']
+        self.speed[row] = numpy.nan if vessel_params['speed'] is None else vessel_params['speed']
+
+    def write_batch(self, positions, vessels):
+        with self.lock:
+            for vessel_params in positions:
+                self.update(vessel_params, vessel=False)
+            for vessel_params in vessels:
+                self.update(vessel_params, position=False)
+
+    def position(self, mmsi=None, imo=None):
+        row = self.index.get(fleet_key(mmsi, imo))
+        if row is None or self.epoch[row] < 0:
+            return None
+        return (float(self.latitude[row]), float(self.longitude[row]), float(self.speed[row]),
+                EPOCH + datetime.timedelta(seconds=int(self.epoch[row])))
+
+    def vessel(self, mmsi=None, imo=None):
+        row = self.index.get(fleet_key(mmsi, imo))
+        if row is None:
+            return None
+        return self.info[row]
+
+    def positions(self):
+        with self.lock:
+            return {name: getattr(self, name)[:self.size].copy() for name, dtype in POSITION_FIELDS}
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name, dtype in POSITION_FIELDS)
+
+    def snapshot(self, path=None):
+        if path is None:
+            path = self.path
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            for name, dtype in POSITION_FIELDS:
+                tmp_path = os.path.join(path, '{}.npy.tmp'.format(name))
+                values = numpy.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=(self.size,))
+                values[:] = getattr(self, name)[:self.size]
+                values.flush()
+                del values
+                os.replace(tmp_path, os.path.join(path, '{}.npy'.format(name)))
+            tmp_path = os.path.join(path, 'info.pkl.tmp')
+            with open(tmp_path, 'wb') as outfile:
+                pickle.dump((self.size, self.info), outfile, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, os.path.join(path, 'info.pkl'))
+
+    def restore(self, path=None):
+        if path is None:
+            path = self.path
+        with open(os.path.join(path, 'info.pkl'), 'rb') as infile:
+            size, info = pickle.load(infile)
+        with self.lock:
+            self.size = 0
+            self.grow(max(self.capacity(), size))
+            for name, dtype in POSITION_FIELDS:
+                values = numpy.load(os.path.join(path, '{}.npy'.format(name)), mmap_mode='r')
+                getattr(self, name)[:size] = values[:size]
+                del values
+            self.size = size
+            self.info = info
+            self.index = {fleet_key(mmsi, imo): row
+                          for row, (mmsi, imo) in enumerate(zip(self.mmsi[:size].tolist(), self.imo[:size].tolist()))}
+
+    def close(self):
+        if self.path is not None:
+            self.snapshot()
@@ -0,0 +1,152 @@
+import argparse
+import datetime
+import re
+import urllib.parse
+
+from bs4 import BeautifulSoup
+
+import database
+from transport import Transport
+
+BASE_URL = 'https://www.vesselfinder.com'
+VESSEL_PATH = re.compile(r'/vessels/(?:(?P<name>[^/?#]*?)-)?IMO-(?P<imo>\d+)-MMSI-(?P<mmsi>\d+)')
+DETAILS_PATH = re.compile(r'/vessels/details/(?P<number>\d+)')
+
+
+def vessel_key(imo, mmsi):
+    if mmsi:
+        return 'mmsi:{}'.format(int(mmsi))
+    if imo:
+        return 'imo:{}'.format(int(imo))
+    return None
+
+
+def vessel_url(name, imo, mmsi):
+    slug = re.sub(r'[^A-Z0-9]+', '-', (name or '').split(',')[0].upper()).strip('-')
+    if not slug:
+        slug = 'VESSEL'
+    return '{}/vessels/{}-IMO-{}-MMSI-{}'.format(BASE_URL, slug, int(imo or 0), int(mmsi or 0))
+
+
+def canonical_url(url):
+    path = urllib.parse.urlparse(url).path
+    match = VESSEL_PATH.search(path)
+    if match is not None:
+        imo = int(match.group('imo'))
+        mmsi = int(match.group('mmsi'))
+        key = vessel_key(imo, mmsi)
+        if key is None:
+            return None, None
+        return key, vessel_url(match.group('name'), imo, mmsi)
+    match = DETAILS_PATH.search(path)
+    if match is not None:
+        number = match.group('number')
+        if len(number) == 9:
+            key = vessel_key(None, number)
+        else:
+            key = vessel_key(number, None)
+        return key, '{}/vessels/details/{}'.format(BASE_URL, int(number))
+    return None, None
+
+
+class Frontier:
+    def __init__(self, path='frontier.sqlite', transport=None, batch_size=1000):
+        self.table = database.FrontierTable(database.SQLiteDatabase(path))
+        self.table.create()
+        self.transport = transport
+        self.batch_size = batch_size
+
+    def add(self, url, priority=0):
+        return self.add_many([url], priority)
+
+    def add_many(self, urls, priority=0):
+        added = 0
+        rows = dict()
+        for url in urls:
+            key, url = canonical_url(url)
+            if key is None:
+                continue
+            rows[key] = (key, url, priority, datetime.datetime.utcnow().isoformat(), 0)
+            if len(rows) >= self.batch_size:
+                added += self.flush(rows)
+        added += self.flush(rows)
+        return added
+
+    def flush(self, rows):
+        n_rows = len(rows)
+        self.table.add_urls(list(rows.values()))
+        self.table.commit()
+        rows.clear()
+        return n_rows
+
+    def seed_table(self, vessel_table, priority=1):
+        query = 'SELECT name, imo, mmsi FROM {table_name}'.format(table_name=vessel_table.full_table_name)
+        cursor = vessel_table.database.connection.cursor()
+        cursor.execute(query)
+
+        def urls():
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if len(rows) == 0:
+                    return
+                for name, imo, mmsi in rows:
+                    if vessel_key(imo, mmsi) is not None:
+                        yield vessel_url(name, imo, mmsi)
+        return self.add_many(urls(), priority)
+
+    def seed_file(self, path, priority=0):
+        with open(path, 'r') as infile:
+            return self.add_many((line.strip() for line in infile if line.strip()), priority)
+
+    def seed_list_page(self, url, pages=1, priority=0, timeout=30):
+        if self.transport is None:
+            self.transport = Transport()
+        added = 0
+        for page in range(1, pages + 1):
+            page_url = url
+            if page > 1:
+                page_url = '{}{}page={}'.format(url, '&' if '?' in url else '?', page)
+            ret = self.transport.get(page_url, timeout=timeout)
+            if ret.status_code != 200:
+                print('could not fetch list page {} ({})'.format(page_url, ret.status_code))
+                break
+            soup = BeautifulSoup(ret.text, 'lxml')
+            links = [urllib.parse.urljoin(page_url, tag['href']) for tag in soup.find_all('a', href=True)]
+            page_added = self.add_many(links, priority)
+            if page_added == 0:
+                break
+            added += page_added
+        return added
+
+    def admit(self, scheduler, limit=1000):
+        rows = self.table.pending(limit)
+        for key, url in rows:
+            scheduler.add(url)
+        scheduler.save()
+        self.table.mark_admitted([key for key, url in rows])
+        self.table.commit()
+        return len(rows)
+
+    def __len__(self):
+        return self.table.count()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frontier', default='frontier.sqlite')
+    parser.add_argument('--seed-table', metavar='SQLITE_PATH')
+    parser.add_argument('--seed-file', action='append', default=[])
+    parser.add_argument('--seed-list', action='append', default=[], metavar='URL')
+    parser.add_argument('--pages', type=int, default=1)
+    parser.add_argument('--priority', type=float, default=0)
+    args = parser.parse_args()
+
+    frontier = Frontier(args.frontier)
+    if args.seed_table is not None:
+        vessel_table = database.VesselTable(database.SQLiteDatabase(args.seed_table))
+        print('Seeded {} urls from {}'.format(frontier.seed_table(vessel_table, args.priority), args.seed_table))
+    for path in args.seed_file:
+        print('Seeded {} urls from {}'.format(frontier.seed_file(path, args.priority), path))
+    for url in args.seed_list:
+        print('Seeded {} urls from {}'.format(frontier.seed_list_page(url, args.pages, args.priority), url))
+    print('Frontier: {} vessels, {} waiting'.format(len(frontier), frontier.table.count(admitted=False)))
@@ -0,0 +1,13 @@
+import numpy
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = numpy.pi * EARTH_RADIUS_KM / 180.0
+
+
+def haversine_km(latitude1, longitude1, latitude2, longitude2):
+    latitude1 = numpy.radians(latitude1)
+    latitude2 = numpy.radians(latitude2)
+    d_latitude = latitude2 - latitude1
+    d_longitude = numpy.radians(numpy.asarray(longitude2) - numpy.asarray(longitude1))
+    a = numpy.sin(d_latitude / 2.0) ** 2 + numpy.cos(latitude1) * numpy.cos(latitude2) * numpy.sin(d_longitude / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
@@ -0,0 +1,238 @@
+import collections
+import contextlib
+import cProfile
+import http.server
+import io
+import json
+import os
+import pstats
+import signal
+import threading
+import time
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in pairs) + '}'
+
+
+class Timer:
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = collections.deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def quantile(self, q):
+        samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[int(q * (len(samples) - 1))]
+
+    def summary(self):
+        summary = {'count': self.count, 'sum': self.total, 'max': self.max}
+        if self.count > 0:
+            summary['mean'] = self.total / self.count
+            summary['p50'] = self.quantile(0.50)
+            summary['p99'] = self.quantile(0.99)
+        return summary
+
+
+class MetricsRegistry:
+    def __init__(self, window=1000):
+        self.window = window
+        self.counters = collections.defaultdict(dict)
+        self.gauges = collections.defaultdict(dict)
+        self.gauge_functions = collections.defaultdict(dict)
+        self.timers = collections.defaultdict(dict)
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.counters[name][key] = self.counters[name].get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[name][label_key(labels)] = value
+
+    def gauge_function(self, name, func, **labels):
+        with self.lock:
+            self.gauge_functions[name][label_key(labels)] = func
+
+    def observe(self, name, seconds, **labels):
+        key = label_key(labels)
+        with self.lock:
+            timer = self.timers[name].get(key)
+            if timer is None:
+                timer = self.timers[name][key] = Timer(self.window)
+            timer.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def collect_gauges(self):
+        with self.lock:
+            gauges = {name: dict(values) for name, values in self.gauges.items()}
+            gauge_functions = {name: dict(funcs) for name, funcs in self.gauge_functions.items()}
+        for name, funcs in gauge_functions.items():
+            for key, func in funcs.items():
+                try:
+                    gauges.setdefault(name, dict())[key] = func()
+                except Exception as e:
+                    print('could not collect gauge {}: {}'.format(name, e))
+        return gauges
+
+    def summary(self):
+        gauges = self.collect_gauges()
+        with self.lock:
+            summary = {'counters': dict(), 'gauges': dict(), 'timers': dict()}
+            for name, values in self.counters.items():
+                for key, value in values.items():
+                    summary['counters'][name + format_labels(key)] = value
+            for name, values in self.timers.items():
+                for key, timer in values.items():
+                    summary['timers'][name + format_labels(key)] = timer.summary()
+        for name, values in gauges.items():
+            for key, value in values.items():
+                summary['gauges'][name + format_labels(key)] = value
+        return summary
+
+    def render_prometheus(self):
+        gauges = self.collect_gauges()
+        lines = []
+        with self.lock:
+            for name, values in sorted(self.counters.items()):
+                lines.append('# TYPE {} counter'.format(name))
+                for key, value in values.items():
+                    lines.append('{}{} {}'.format(name, format_labels(key), value))
+            for name, values in sorted(self.timers.items()):
+                lines.append('# TYPE {} summary'.format(name))
+                for key, timer in values.items():
+                    for q in [0.5, 0.99]:
+                        value = timer.quantile(q)
+                        if value is not None:
+                            lines.append('{}{} {}'.format(name, format_labels(key, [('quantile', q)]), value))
+                    lines.append('{}_sum{} {}'.format(name, format_labels(key), timer.total))
+                    lines.append('{}_count{} {}'.format(name, format_labels(key), timer.count))
+        for name, values in sorted(gauges.items()):
+            lines.append('# TYPE {} gauge'.format(name))
+            for key, value in values.items():
+                if value is not None:
+                    lines.append('{}{} {}'.format(name, format_labels(key), value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = registry
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = self.registry.render_prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/summary':
+            body = json.dumps(self.registry.summary(), default=str).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+    def __init__(self, port=9108, host='127.0.0.1', registry=registry):
+        handler = type('BoundMetricsHandler', (MetricsHandler,), {'registry': registry})
+        self.server = http.server.ThreadingHTTPServer((host, port), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JsonSummary:
+    def __init__(self, path='metrics.json', interval=300, registry=registry):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.last_written = None
+
+    def write_if_due(self):
+        now = time.monotonic()
+        if self.last_written is not None and now - self.last_written < self.interval:
+            return False
+        self.write()
+        self.last_written = now
+        return True
+
+    def write(self):
+        summary = self.registry.summary()
+        summary['time'] = time.time()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump(summary, outfile, default=str, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+class CycleProfiler:
+    def __init__(self, output_dir='profiles', top=25):
+        self.output_dir = output_dir
+        self.top = top
+        self.requested = threading.Event()
+
+    def request(self, *args):
+        self.requested.set()
+
+    def install_signal(self, signum=signal.SIGUSR1):
+        signal.signal(signum, self.request)
+
+    @contextlib.contextmanager
+    def cycle(self):
+        if not self.requested.is_set():
+            yield
+            return
+        self.requested.clear()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, 'cycle-{}.prof'.format(int(time.time())))
+            profiler.dump_stats(path)
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(self.top)
+            print('Profiled cycle written to {}'.format(path))
+            print(output.getvalue())
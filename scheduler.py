@@ -0,0 +1,111 @@
+import collections
+import datetime
+import json
+import time
+
+import database
+
+
+class PollScheduler:
+    def __init__(self, path=None, min_interval=120, max_interval=6 * 3600, default_interval=600,
+                 track_distance=1.0, requests_per_minute=60, db=None):
+        if db is None:
+            db = database.SQLiteDatabase(path or ':memory:')
+        self.table = database.ScheduleTable(db)
+        self.table.create()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_interval = default_interval
+        self.track_distance = track_distance
+        self.requests_per_minute = requests_per_minute
+        self.dispatched = collections.deque()
+        self.in_flight = set()
+
+    def add(self, url, due=None):
+        if due is None:
+            due = time.time()
+        self.table.add_urls([(url, due, self.default_interval, None, None, 0)])
+
+    def next_interval(self, speed, report_age, errors):
+        if speed is None:
+            interval = self.default_interval
+        elif speed <= 0:
+            interval = self.max_interval
+        else:
+            interval = 3600.0 * self.track_distance / speed
+        if report_age is not None:
+            interval = max(interval, report_age / 2.0)
+        interval *= 2 ** min(errors, 6)
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def budget(self, now):
+        while self.dispatched and self.dispatched[0] <= now - 60:
+            self.dispatched.popleft()
+        return max(0, self.requests_per_minute - len(self.dispatched))
+
+    def due_urls(self, now=None):
+        if now is None:
+            now = time.time()
+        budget = self.budget(now)
+        if budget == 0:
+            return []
+        rows = self.table.due(now, budget)
+        self.table.reschedule([(now + interval, url) for url, interval in rows])
+        self.dispatched.extend(now for url, interval in rows)
+        urls = [url for url, interval in rows]
+        self.in_flight.update(urls)
+        return urls
+
+    def seconds_until_next(self, now=None):
+        if now is None:
+            now = time.time()
+        wait = self.max_interval
+        next_due = self.table.next_due()
+        if next_due is not None:
+            wait = next_due - now
+        if self.dispatched and self.budget(now) == 0:
+            wait = max(wait, self.dispatched[0] + 60 - now)
+        return max(0, wait)
+
+    def success_interval(self, vessel_params):
+        report_age = None
+        report_date = vessel_params.get('date')
+        if report_date is not None:
+            report_age = (datetime.datetime.utcnow() - report_date).total_seconds()
+        return self.next_interval(vessel_params.get('speed'), report_age, 0)
+
+    def record_success(self, url, vessel_params):
+        self.in_flight.discard(url)
+        self.add(url)
+        report_date = vessel_params.get('date')
+        if report_date is not None:
+            report_date = report_date.isoformat()
+        interval = self.success_interval(vessel_params)
+        self.table.update_entry(url, time.time() + interval, interval, vessel_params.get('speed'), report_date, 0)
+
+    def record_failure(self, url):
+        self.in_flight.discard(url)
+        self.add(url)
+        speed, report_date, errors = self.table.entry(url)
+        errors += 1
+        interval = self.next_interval(speed, None, errors)
+        self.table.update_entry(url, time.time() + interval, interval, speed, report_date, errors)
+
+    def settle(self, unchanged_urls=()):
+        self.in_flight.difference_update(unchanged_urls)
+        for url in list(self.in_flight):
+            self.record_failure(url)
+
+    def import_json(self, path):
+        with open(path, 'r') as infile:
+            state = json.load(infile)
+        self.table.add_urls([(url, entry['due'], entry['interval'], entry['speed'], entry['report_date'],
+                              entry['errors']) for url, entry in state.items()])
+        self.save()
+        return len(state)
+
+    def save(self):
+        self.table.commit()
+
+    def __len__(self):
+        return self.table.count()
@@ -0,0 +1,461 @@
+import datetime
+import glob
+import hashlib
+import os
+import pickle
+import queue
+import threading
+import time
+import uuid
+
+import database
+from metrics import registry
+from transport import RetryPolicy
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+VESSEL_COLUMNS = ['mmsi', 'imo', 'name', 'country', 'ship_type', 'gt', 'built', 'length', 'width']
+FLUSH = 'flush'
+
+
+class ChangeCache:
+    def __init__(self, path=None):
+        self.entries = dict()
+        self.dirty = set()
+        self.table = None
+        if path is not None:
+            self.table = database.ChangeCacheTable(database.SQLiteDatabase(path))
+            self.table.create()
+            for vessel_key, date, vessel_hash in self.table.select_all():
+                self.entries[vessel_key] = (date, vessel_hash)
+
+    def vessel_key(self, vessel_params):
+        if vessel_params['mmsi'] is not None:
+            return 'mmsi:{}'.format(vessel_params['mmsi'])
+        if vessel_params['imo'] is not None:
+            return 'imo:{}'.format(vessel_params['imo'])
+        return 'url:{}'.format(vessel_params.get('url'))
+
+    def vessel_hash(self, vessel_params):
+        attributes = repr(tuple(vessel_params[column] for column in VESSEL_COLUMNS))
+        return hashlib.sha1(attributes.encode('utf-8')).hexdigest()
+
+    def changes(self, batch):
+        positions = []
+        vessels = []
+        for vessel_params in batch:
+            vessel_key = self.vessel_key(vessel_params)
+            date = vessel_params['date']
+            if date is not None:
+                date = date.isoformat()
+            vessel_hash = self.vessel_hash(vessel_params)
+            known = vessel_key in self.entries
+            last_date, last_hash = self.entries.get(vessel_key, (None, None))
+            new_position = not known or (date is not None and (last_date is None or date > last_date))
+            new_vessel = vessel_hash != last_hash
+            if not new_position and not new_vessel:
+                continue
+            if new_position:
+                positions.append(vessel_params)
+                last_date = date
+            if new_vessel:
+                vessels.append(vessel_params)
+            self.entries[vessel_key] = (last_date, vessel_hash)
+            self.dirty.add(vessel_key)
+        return positions, vessels
+
+    def forget(self, batch):
+        for vessel_params in batch:
+            vessel_key = self.vessel_key(vessel_params)
+            self.entries.pop(vessel_key, None)
+            self.dirty.discard(vessel_key)
+
+    def save(self):
+        if self.table is None or len(self.dirty) == 0:
+            return
+        entries = [(vessel_key,) + self.entries[vessel_key] for vessel_key in self.dirty]
+        self.table.upsert_entries(entries)
+        self.table.commit()
+        self.dirty.clear()
+
+
+class Sink:
+    def write_batch(self, positions, vessels):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def flush_if_due(self):
+        pass
+
+    def buffered(self):
+        return 0
+
+    def reconnect(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class TableSink(Sink):
+    def __init__(self, position_table, vessel_table):
+        self.position_table = position_table
+        self.vessel_table = vessel_table
+        self.database = position_table.database
+
+    def write_batch(self, positions, vessels):
+        try:
+            with registry.timer('sink_upsert_seconds', table=self.position_table.full_table_name):
+                self.position_table.upsert_positions(positions)
+            with registry.timer('sink_upsert_seconds', table=self.vessel_table.full_table_name):
+                self.vessel_table.upsert_vessels(vessels)
+            with registry.timer('sink_commit_seconds', database=self.database.__class__.__name__):
+                self.database.commit()
+        except Exception:
+            self.database.rollback()
+            raise
+
+    def reconnect(self):
+        self.database.reconnect()
+
+
+class CsvSink(Sink):
+    def __init__(self, path='positions.csv'):
+        self.path = path
+
+    def write_batch(self, positions, vessels):
+        if len(positions) == 0:
+            return
+        import pandas
+        df = pandas.DataFrame(positions, index=['mmsi'] * len(positions))
+        with open(self.path, 'a') as csv:
+            df.to_csv(path_or_buf=csv, header=False)
+
+
+class ParquetSink(Sink):
+    def __init__(self, root='positions', rows_per_file=10000, max_buffer_age=3600, compact_interval=3600):
+        if pyarrow is None:
+            raise RuntimeError('ParquetSink requires pyarrow')
+        self.root = root
+        self.rows_per_file = rows_per_file
+        self.max_buffer_age = max_buffer_age
+        self.schema = pyarrow.schema([('mmsi', pyarrow.int64()),
+                                      ('imo', pyarrow.int64()),
+                                      ('date', pyarrow.timestamp('s')),
+                                      ('latitude', pyarrow.float64()),
+                                      ('longitude', pyarrow.float64()),
+                                      ('speed', pyarrow.float32())])
+        self.buffer = dict()
+        self.buffered_rows = 0
+        self.buffer_started = None
+        self.compact_interval = compact_interval
+        self.last_compaction = time.monotonic()
+
+    def partition(self, date):
+        if date is None:
+            return 'day=unknown'
+        return 'day={}'.format(date.strftime('%Y-%m-%d'))
+
+    def write_batch(self, positions, vessels):
+        if self.buffered_rows == 0:
+            self.buffer_started = time.monotonic()
+        for position in positions:
+            rows = self.buffer.setdefault(self.partition(position['date']), [])
+            rows.append(position)
+        self.buffered_rows += len(positions)
+        try:
+            self.flush_if_due()
+        except Exception as e:
+            registry.increment('parquet_flush_failures_total')
+            print('Parquet flush failed, keeping {} rows buffered: {}'.format(self.buffered_rows, e))
+
+    def buffered(self):
+        return self.buffered_rows
+
+    def flush_if_due(self):
+        if self.buffered_rows == 0:
+            return
+        if self.buffered_rows >= self.rows_per_file or time.monotonic() - self.buffer_started >= self.max_buffer_age:
+            self.flush()
+
+    def flush(self):
+        written = []
+        try:
+            for partition, rows in self.buffer.items():
+                columns = {name: [row[name] for row in rows] for name in self.schema.names}
+                table = pyarrow.Table.from_pydict(columns, schema=self.schema)
+                file_name = 'part-{}-{}.parquet'.format(datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'),
+                                                        uuid.uuid4().hex[:8])
+                written.append((partition, self.write_table(partition, table, file_name, publish=False)))
+        except Exception:
+            for partition, (tmp_path, path) in written:
+                os.remove(tmp_path)
+            raise
+        for partition, (tmp_path, path) in written:
+            os.replace(tmp_path, path)
+            self.buffered_rows -= len(self.buffer.pop(partition))
+        if self.compact_interval is not None and time.monotonic() - self.last_compaction >= self.compact_interval:
+            self.compact_closed_partitions()
+            self.last_compaction = time.monotonic()
+
+    def write_table(self, partition, table, file_name, publish=True):
+        directory = os.path.join(self.root, partition)
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, '.' + file_name + '.tmp')
+        path = os.path.join(directory, file_name)
+        pyarrow.parquet.write_table(table, tmp_path, compression='zstd')
+        if publish:
+            os.replace(tmp_path, path)
+        return tmp_path, path
+
+    def compact(self, min_files=2, skip_partitions=()):
+        for directory in sorted(glob.glob(os.path.join(self.root, 'day=*'))):
+            partition = os.path.basename(directory)
+            paths = sorted(glob.glob(os.path.join(directory, 'part-*.parquet')))
+            if partition in skip_partitions or len(paths) < min_files:
+                continue
+            table = pyarrow.concat_tables([pyarrow.parquet.read_table(path, schema=self.schema) for path in paths])
+            table = table.sort_by([('mmsi', 'ascending'), ('date', 'ascending')])
+            self.write_table(partition, table, 'part-{}-compacted.parquet'.format(uuid.uuid4().hex[:8]))
+            for path in paths:
+                os.remove(path)
+
+    def compact_closed_partitions(self, min_files=2):
+        today = self.partition(datetime.datetime.utcnow())
+        self.compact(min_files=min_files, skip_partitions=(today, 'day=unknown'))
+
+    def close(self):
+        self.flush()
+
+
+class SinkWorker(Sink):
+    def __init__(self, sink, name=None, queue_size=100, spool_dir='spool', retry_policy=None, max_replays=5):
+        self.sink = sink
+        if name is None:
+            name = sink.__class__.__name__
+        self.name = name
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.spool_dir = os.path.join(spool_dir, name)
+        os.makedirs(self.spool_dir, exist_ok=True)
+        if retry_policy is None:
+            retry_policy = RetryPolicy(base_delay=1.0, max_delay=60.0)
+        self.retry_policy = retry_policy
+        self.max_replays = max_replays
+        self.replays = dict()
+        self.lock = threading.Lock()
+        self.batch_seq = time.time_ns()
+        self.queued = set()
+        self.unflushed = []
+        self.written = 0
+        self.spooled = 0
+        self.failures = 0
+        self.stopping = threading.Event()
+        registry.gauge_function('sink_queue_depth', self.queue.qsize, sink=name)
+        registry.gauge_function('sink_spool_files', self.spool_files, sink=name)
+        self.thread = threading.Thread(target=self.run, name='sink-{}'.format(name), daemon=True)
+        self.thread.start()
+
+    def write_batch(self, positions, vessels):
+        with self.lock:
+            self.batch_seq += 1
+            seq = self.batch_seq
+            self.queued.add(seq)
+        self.spool(seq, positions, vessels)
+        try:
+            self.queue.put_nowait((seq, positions, vessels))
+        except queue.Full:
+            registry.increment('sink_spooled_total', sink=self.name)
+            with self.lock:
+                self.queued.discard(seq)
+                self.spooled += 1
+
+    def spool_path(self, seq):
+        return os.path.join(self.spool_dir, '{:020d}.pkl'.format(seq))
+
+    def spool(self, seq, positions, vessels):
+        path = self.spool_path(seq)
+        tmp_path = os.path.join(self.spool_dir, '.' + os.path.basename(path) + '.tmp')
+        with open(tmp_path, 'wb') as outfile:
+            pickle.dump((positions, vessels), outfile)
+        os.replace(tmp_path, path)
+
+    def run(self):
+        while True:
+            try:
+                batch = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                self.replay_spool()
+                self.flush_sink(due_only=True)
+                if self.stopping.is_set():
+                    return
+                continue
+            if batch is None:
+                return
+            if batch == FLUSH:
+                self.flush_sink()
+                continue
+            seq, positions, vessels = batch
+            written = self.replay_spool(before=seq) and self.write(positions, vessels)
+            with self.lock:
+                self.queued.discard(seq)
+                if not written:
+                    self.spooled += 1
+            if written:
+                self.confirm(self.spool_path(seq))
+
+    def write(self, positions, vessels):
+        try:
+            with registry.timer('sink_write_seconds', sink=self.name):
+                self.sink.write_batch(positions, vessels)
+        except Exception as e:
+            self.failures += 1
+            registry.increment('sink_failures_total', sink=self.name)
+            print('Sink {} failed: {}'.format(self.name, e))
+            self.reconnect()
+            return False
+        self.written += 1
+        registry.increment('sink_rows_total', len(positions), sink=self.name)
+        return True
+
+    def flush(self):
+        try:
+            self.queue.put_nowait(FLUSH)
+        except queue.Full:
+            pass
+
+    def flush_sink(self, due_only=False):
+        try:
+            if due_only:
+                self.sink.flush_if_due()
+            else:
+                self.sink.flush()
+        except Exception as e:
+            self.failures += 1
+            registry.increment('sink_failures_total', sink=self.name)
+            print('Sink {} failed to flush: {}'.format(self.name, e))
+        self.remove_flushed()
+
+    def confirm(self, path):
+        self.unflushed.append(path)
+        self.remove_flushed()
+
+    def remove_flushed(self):
+        if self.sink.buffered():
+            return
+        for path in self.unflushed:
+            os.remove(path)
+        self.unflushed = []
+
+    def reconnect(self):
+        attempt = 1
+        while not self.stopping.wait(self.retry_policy.delay(attempt)):
+            try:
+                self.sink.reconnect()
+                return True
+            except Exception as e:
+                print('Sink {} reconnect failed: {}'.format(self.name, e))
+                attempt += 1
+        return False
+
+    def replay_spool(self, before=None):
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, '*.pkl'))):
+            seq = int(os.path.basename(path)[:20])
+            if before is not None and seq >= before:
+                return True
+            with self.lock:
+                if seq in self.queued:
+                    return True
+            if path in self.unflushed:
+                continue
+            if self.stopping.is_set():
+                return False
+            with open(path, 'rb') as infile:
+                positions, vessels = pickle.load(infile)
+            if not self.write(positions, vessels):
+                self.replays[path] = self.replays.get(path, 0) + 1
+                if self.replays[path] < self.max_replays:
+                    return False
+                del self.replays[path]
+                print('Sink {} giving up on spooled batch {}'.format(self.name, path))
+                os.makedirs(os.path.join(self.spool_dir, 'failed'), exist_ok=True)
+                os.replace(path, os.path.join(self.spool_dir, 'failed', os.path.basename(path)))
+                continue
+            self.replays.pop(path, None)
+            self.confirm(path)
+        return True
+
+    def spool_files(self):
+        return len(glob.glob(os.path.join(self.spool_dir, '*.pkl')))
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'written': self.written, 'spooled': self.spooled,
+                'failures': self.failures}
+
+    def close(self, timeout=30):
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+        self.stopping.set()
+        self.thread.join()
+        self.sink.close()
+        self.remove_flushed()
+
+
+class BatchWriter:
+    def __init__(self, sinks, batch_size=100, flush_interval=60, change_cache=None):
+        self.sinks = sinks
+        self.change_cache = change_cache
+        self.skipped = 0
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.buffer_started = None
+
+    def write(self, vessel_params):
+        if len(self.buffer) == 0:
+            self.buffer_started = time.monotonic()
+        self.buffer.append(dict(vessel_params))
+        if len(self.buffer) >= self.batch_size or time.monotonic() - self.buffer_started >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        batch = self.buffer
+        self.buffer = []
+        positions = vessels = batch
+        if self.change_cache is not None:
+            positions, vessels = self.change_cache.changes(batch)
+            self.skipped += len(batch) - len(positions)
+            registry.increment('writer_unchanged_total', len(batch) - len(positions))
+            if len(positions) == 0 and len(vessels) == 0:
+                return
+        failed = False
+        for sink in self.sinks:
+            try:
+                sink.write_batch(positions, vessels)
+            except Exception as e:
+                failed = True
+                print('Failed to write {} rows to {}: {}'.format(len(batch), sink.__class__.__name__, e))
+        if self.change_cache is not None:
+            if failed:
+                self.change_cache.forget(batch)
+            self.change_cache.save()
+
+    def flush_sinks(self):
+        self.flush()
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
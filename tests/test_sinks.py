@@ -0,0 +1,78 @@
+import datetime
+import glob
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pyarrow = pytest.importorskip('pyarrow')
+import pyarrow.parquet
+
+from sinks import ParquetSink, SinkWorker
+
+
+def position(mmsi, day):
+    return {'mmsi': mmsi, 'imo': None, 'date': datetime.datetime(2020, 1, day), 'latitude': 33.0,
+            'longitude': -118.0, 'speed': 1.0}
+
+
+def parquet_rows(root):
+    return sum(pyarrow.parquet.read_metadata(path).num_rows
+               for path in glob.glob(os.path.join(str(root), 'day=*', '*.parquet')))
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+class FlakyParquetSink(ParquetSink):
+    def __init__(self, root, fail_on_call):
+        super(FlakyParquetSink, self).__init__(root, rows_per_file=2, compact_interval=None)
+        self.calls = 0
+        self.fail_on_call = fail_on_call
+
+    def write_table(self, partition, table, file_name, publish=True):
+        self.calls += 1
+        if self.calls == self.fail_on_call:
+            raise OSError('disk full')
+        return super(FlakyParquetSink, self).write_table(partition, table, file_name, publish)
+
+
+def test_failed_parquet_flush_is_not_appended_twice(tmp_path):
+    sink = FlakyParquetSink(tmp_path / 'positions', fail_on_call=2)
+    worker = SinkWorker(sink, name='parquet', spool_dir=str(tmp_path / 'spool'))
+    worker.write_batch([position(1, 1)], [])
+    worker.write_batch([position(2, 2)], [])
+    assert wait_for(lambda: worker.stats()['queued'] == 0 and sink.calls >= 2)
+    assert parquet_rows(tmp_path / 'positions') == 0
+    assert sink.buffered() == 2
+    assert worker.spool_files() == 2
+
+    worker.flush()
+    assert wait_for(lambda: sink.buffered() == 0)
+    worker.close()
+    assert parquet_rows(tmp_path / 'positions') == 2
+    assert worker.spool_files() == 0
+
+
+def test_unflushed_parquet_batches_are_replayed_after_a_crash(tmp_path):
+    sink = ParquetSink(str(tmp_path / 'positions'), compact_interval=None)
+    worker = SinkWorker(sink, name='parquet', spool_dir=str(tmp_path / 'spool'))
+    worker.write_batch([position(1, 1)], [])
+    assert wait_for(lambda: worker.written == 1)
+    assert worker.spool_files() == 1
+
+    sink = ParquetSink(str(tmp_path / 'positions'), compact_interval=None)
+    restarted = SinkWorker(sink, name='parquet', spool_dir=str(tmp_path / 'spool'))
+    assert wait_for(lambda: restarted.written == 1)
+    restarted.close()
+    assert parquet_rows(tmp_path / 'positions') == 1
+    assert restarted.spool_files() == 0
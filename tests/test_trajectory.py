@@ -0,0 +1,52 @@
+import datetime
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import position_arrays
+from trajectory import TrajectoryCleaner, vessel_ids
+
+START = datetime.datetime(2020, 1, 1)
+
+
+def track(fixes, mmsi=367000000):
+    return [(mmsi, 0, START + datetime.timedelta(minutes=10 * i), latitude, longitude, 5.0)
+            for i, (latitude, longitude) in enumerate(fixes)]
+
+
+def kept_latitudes(rows):
+    arrays = position_arrays(rows)
+    keep = TrajectoryCleaner().reject_outliers(arrays, vessel_ids(arrays))
+    return arrays['latitude'][keep].tolist()
+
+
+def test_spikes_at_start_middle_and_end_are_removed():
+    fixes = [(10.0, 10.0), (34.0, -118.0), (34.01, -118.0), (34.02, -118.0), (40.0, -118.0),
+             (34.03, -118.0), (34.04, -118.0), (34.05, -118.0), (50.0, -118.0)]
+    assert kept_latitudes(track(fixes)) == [34.0, 34.01, 34.02, 34.03, 34.04, 34.05]
+
+
+def test_plausible_track_is_kept():
+    fixes = [(34.0 + 0.01 * i, -118.0) for i in range(10)]
+    assert kept_latitudes(track(fixes)) == [latitude for latitude, longitude in fixes]
+
+
+def test_short_tracks_are_kept():
+    rows = track([(34.0, -118.0)], mmsi=1) + track([(34.0, -118.0), (40.0, -118.0)], mmsi=2)
+    assert kept_latitudes(rows) == [34.0, 34.0, 40.0]
+
+
+def test_tracks_are_checked_independently():
+    rows = track([(34.0, -118.0), (34.01, -118.0)], mmsi=1) + track([(50.0, -118.0), (50.01, -118.0)], mmsi=2)
+    assert kept_latitudes(rows) == [34.0, 34.01, 50.0, 50.01]
+
+
+def test_clean_counts_outliers():
+    cleaner = TrajectoryCleaner()
+    fixes = [(10.0, 10.0)] + [(34.0 + 0.01 * i, -118.0) for i in range(5)]
+    arrays = cleaner.clean(position_arrays(track(fixes)))
+    assert cleaner.stats['outliers'] == 1
+    assert numpy.all(arrays['latitude'] >= 34.0)
@@ -0,0 +1,112 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+from scheduler import PollScheduler
+from workqueue import HashRing, WorkQueue, shard_for
+
+URL = 'https://www.vesselfinder.com/vessels/TEST-IMO-0-MMSI-{}'
+
+
+def open_queue(path, worker_id, **kwargs):
+    kwargs.setdefault('n_shards', 64)
+    return WorkQueue(database.SQLiteDatabase(str(path)), worker_id=worker_id, **kwargs)
+
+
+def fill(queue, n_vessels, due=0):
+    for i in range(n_vessels):
+        queue.add(URL.format(367000000 + i), due=due)
+    queue.flush()
+
+
+def queue_row(queue, url):
+    query = 'SELECT due_at, poll_interval, attempts, lease_owner, lease_expires FROM work_queue WHERE url = ?'
+    queue.table.database.cursor.execute(query, (url,))
+    return queue.table.database.cursor.fetchone()
+
+
+def test_shard_for_is_stable():
+    assert shard_for('mmsi:367000000', 1024) == shard_for('mmsi:367000000', 1024)
+    assert 0 <= shard_for('mmsi:367000000', 1024) < 1024
+
+
+def test_hash_ring_moves_only_the_departed_workers_shards():
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b'])
+    for shard in range(256):
+        if before.owner(str(shard)) != 'c':
+            assert after.owner(str(shard)) == before.owner(str(shard))
+
+
+def test_workers_split_shards_and_claims(tmp_path):
+    path = tmp_path / 'queue.sqlite'
+    a = open_queue(path, 'a', claim_size=1000)
+    b = open_queue(path, 'b', claim_size=1000)
+    a.heartbeat()
+    assert set(a.shards).isdisjoint(b.shards)
+    assert set(a.shards) | set(b.shards) == set(range(64))
+
+    fill(a, 200)
+    claimed_a = a.due_urls(now=1)
+    claimed_b = b.due_urls(now=1)
+    assert set(claimed_a).isdisjoint(claimed_b)
+    assert len(claimed_a) + len(claimed_b) == 200
+    assert a.due_urls(now=1) == []
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    path = tmp_path / 'queue.sqlite'
+    dead = open_queue(path, 'dead', lease_seconds=10)
+    fill(dead, 1)
+    now = dead.last_heartbeat
+    assert len(dead.due_urls(now=now)) == 1
+
+    live = open_queue(path, 'live', worker_timeout=5)
+    live.heartbeat(now=now + 20)
+    assert len(live.shards) == 64
+    assert live.due_urls(now=now + 20) == [URL.format(367000000)]
+
+
+def test_settle_releases_every_claimed_url(tmp_path):
+    queue = open_queue(path=tmp_path / 'queue.sqlite', worker_id='a')
+    fill(queue, 3)
+    success, unchanged, lost = queue.due_urls(now=1)
+    queue.record_success(success, {'speed': 10.0})
+    queue.settle([unchanged])
+    assert queue.leases == {}
+
+    interval = queue.scheduler.default_interval
+    due_at, poll_interval, attempts, lease_owner, lease_expires = queue_row(queue, unchanged)
+    assert (poll_interval, attempts, lease_owner, lease_expires) == (interval, 0, None, None)
+    due_at, poll_interval, attempts, lease_owner, lease_expires = queue_row(queue, lost)
+    assert (attempts, lease_owner) == (1, None)
+
+    queue.heartbeat()
+    assert all(queue_row(queue, url)[3] is None for url in [success, unchanged, lost])
+
+
+def test_close_releases_leases_and_leaves_the_ring(tmp_path):
+    path = tmp_path / 'queue.sqlite'
+    a = open_queue(path, 'a')
+    fill(a, 10)
+    claimed = a.due_urls(now=1)
+    a.close()
+    assert all(queue_row(a, url)[3] is None for url in claimed)
+
+    b = open_queue(path, 'b')
+    assert len(b.shards) == 64
+    assert len(b.due_urls()) == 10
+
+
+def test_poll_scheduler_settle_counts_unreported_urls_as_failures():
+    scheduler = PollScheduler()
+    for url in ['ok', 'unchanged', 'lost']:
+        scheduler.add(url, due=0)
+    assert sorted(scheduler.due_urls(now=1)) == ['lost', 'ok', 'unchanged']
+    scheduler.record_success('ok', {'speed': 10.0})
+    scheduler.settle(['unchanged'])
+    assert scheduler.in_flight == set()
+    assert scheduler.table.entry('unchanged')[2] == 0
+    assert scheduler.table.entry('lost')[2] == 1
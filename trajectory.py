@@ -0,0 +1,203 @@
+import argparse
+
+import numpy
+
+import database
+from database import concatenate_arrays
+from geo import KM_PER_DEGREE, haversine_km
+
+KM_PER_NAUTICAL_MILE = 1.852
+
+
+class CleanPositionTable(database.PositionTable):
+    table_name = 'positions_clean'
+
+    def migrations(self):
+        return []
+
+
+def vessel_ids(arrays):
+    return numpy.where(arrays['mmsi'] != 0, arrays['mmsi'], -arrays['imo'])
+
+
+def take(arrays, index):
+    return {name: values[index] for name, values in arrays.items()}
+
+
+def implied_speeds(arrays, vessel):
+    n_rows = len(vessel)
+    speeds = numpy.full(n_rows, numpy.nan)
+    if n_rows < 2:
+        return speeds
+    distance = haversine_km(arrays['latitude'][:-1], arrays['longitude'][:-1],
+                            arrays['latitude'][1:], arrays['longitude'][1:])
+    hours = numpy.diff(arrays['date'].astype('int64')) / 3600.0
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        knots = distance / KM_PER_NAUTICAL_MILE / hours
+    knots[hours <= 0] = numpy.inf
+    knots[vessel[1:] != vessel[:-1]] = numpy.nan
+    speeds[1:] = knots
+    return speeds
+
+
+def douglas_peucker(latitude, longitude, vessel, tolerance_km):
+    n_rows = len(vessel)
+    keep = numpy.zeros(n_rows, dtype=bool)
+    if n_rows == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    boundaries = numpy.flatnonzero(vessel[1:] != vessel[:-1])
+    keep[boundaries] = True
+    keep[boundaries + 1] = True
+    y = latitude * KM_PER_DEGREE
+    x = longitude * KM_PER_DEGREE * numpy.cos(numpy.radians(latitude))
+    rows = numpy.arange(n_rows)
+    while True:
+        kept = numpy.flatnonzero(keep)
+        segment = numpy.searchsorted(kept, rows, side='right') - 1
+        first = kept[segment]
+        last = kept[numpy.minimum(segment + 1, len(kept) - 1)]
+        dx = x[last] - x[first]
+        dy = y[last] - y[first]
+        px = x - x[first]
+        py = y - y[first]
+        length = numpy.hypot(dx, dy)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            distance = numpy.where(length > 0, numpy.abs(dx * py - dy * px) / length, numpy.hypot(px, py))
+        distance[keep] = -1.0
+        farthest = numpy.maximum.reduceat(distance, kept)
+        splits = numpy.flatnonzero((distance > tolerance_km) & (distance == farthest[segment]))
+        if len(splits) == 0:
+            return keep
+        unique, first_split = numpy.unique(segment[splits], return_index=True)
+        keep[splits[first_split]] = True
+
+
+class TrajectoryCleaner:
+    def __init__(self, max_speed=50.0, bucket_seconds=None, tolerance_km=None, max_iterations=10):
+        self.max_speed = max_speed
+        self.bucket_seconds = bucket_seconds
+        self.tolerance_km = tolerance_km
+        self.max_iterations = max_iterations
+        self.stats = {'read': 0, 'invalid': 0, 'duplicates': 0, 'outliers': 0, 'downsampled': 0, 'written': 0}
+
+    def valid(self, arrays):
+        latitude = arrays['latitude']
+        longitude = arrays['longitude']
+        keep = ~numpy.isnat(arrays['date']) & numpy.isfinite(latitude) & numpy.isfinite(longitude)
+        keep &= (numpy.abs(latitude) <= 90) & (numpy.abs(longitude) <= 180) & ((latitude != 0) | (longitude != 0))
+        return keep
+
+    def deduplicate(self, arrays, vessel):
+        keep = numpy.ones(len(vessel), dtype=bool)
+        same_vessel = vessel[1:] == vessel[:-1]
+        same_fix = (arrays['date'][1:] == arrays['date'][:-1]) | (
+            (arrays['latitude'][1:] == arrays['latitude'][:-1]) & (arrays['longitude'][1:] == arrays['longitude'][:-1]))
+        keep[1:] = ~(same_vessel & same_fix)
+        return keep
+
+    def reject_outliers(self, arrays, vessel):
+        index = numpy.arange(len(vessel))
+        for _ in range(self.max_iterations):
+            current = take(arrays, index)
+            speed_in = implied_speeds(current, vessel[index])
+            speed_out = numpy.append(speed_in[1:], numpy.nan)
+            previous_in = numpy.append(numpy.nan, speed_in[:-1])
+            next_out = numpy.append(speed_out[1:], numpy.nan)
+            too_fast_in = speed_in > self.max_speed
+            too_fast_out = speed_out > self.max_speed
+            first = numpy.isnan(speed_in) & too_fast_out & (next_out <= self.max_speed)
+            last = numpy.isnan(speed_out) & too_fast_in & (previous_in <= self.max_speed)
+            outliers = (too_fast_in & too_fast_out) | first | last
+            if not outliers.any():
+                break
+            index = index[~outliers]
+        keep = numpy.zeros(len(vessel), dtype=bool)
+        keep[index] = True
+        return keep
+
+    def downsample(self, arrays, vessel):
+        keep = numpy.ones(len(vessel), dtype=bool)
+        if self.bucket_seconds:
+            bucket = arrays['date'].astype('int64') // self.bucket_seconds
+            keep[1:] = (vessel[1:] != vessel[:-1]) | (bucket[1:] != bucket[:-1])
+        if self.tolerance_km:
+            keep &= douglas_peucker(arrays['latitude'], arrays['longitude'], vessel, self.tolerance_km)
+        return keep
+
+    def clean(self, arrays):
+        self.stats['read'] += len(arrays['date'])
+        for stage, name in [(lambda a, v: self.valid(a), 'invalid'), (self.deduplicate, 'duplicates'),
+                            (self.reject_outliers, 'outliers'), (self.downsample, 'downsampled')]:
+            keep = stage(arrays, vessel_ids(arrays))
+            self.stats[name] += int((~keep).sum())
+            arrays = take(arrays, keep)
+        return arrays
+
+    def vessel_chunks(self, chunks):
+        carry = None
+        for chunk in chunks:
+            if carry is not None:
+                chunk = concatenate_arrays([carry, chunk])
+            vessel = vessel_ids(chunk)
+            if len(vessel) == 0:
+                continue
+            last_start = numpy.flatnonzero(vessel == vessel[-1])[0]
+            carry = take(chunk, slice(last_start, None))
+            if last_start > 0:
+                yield take(chunk, slice(0, last_start))
+        if carry is not None:
+            yield carry
+
+    def source_chunks(self, source_table, chunksize):
+        query = 'SELECT mmsi, imo, date, latitude, longitude, speed FROM {table_name} ' \
+                'WHERE {key_filter} ORDER BY {key}, date'
+        for key_filter, key in [('mmsi IS NOT NULL', 'mmsi'), ('mmsi IS NULL AND imo IS NOT NULL', 'imo')]:
+            for chunk in source_table.iter_position_arrays(query.format(table_name=source_table.full_table_name,
+                                                                        key_filter=key_filter, key=key),
+                                                           (), chunksize):
+                yield chunk
+
+    def records(self, arrays):
+        columns = dict()
+        for name, values in arrays.items():
+            columns[name] = values.tolist()
+        for name in ['mmsi', 'imo']:
+            columns[name] = [value if value != 0 else None for value in columns[name]]
+        for name in ['latitude', 'longitude', 'speed']:
+            columns[name] = [value if value == value else None for value in columns[name]]
+        return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+    def run(self, source_table, target_table, chunksize=100000, progress=print):
+        for arrays in self.vessel_chunks(self.source_chunks(source_table, chunksize)):
+            arrays = self.clean(arrays)
+            target_table.upsert_positions(self.records(arrays))
+            target_table.commit()
+            self.stats['written'] += len(arrays['date'])
+            if progress is not None:
+                progress('trajectories: {}'.format(self.stats))
+        return self.stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sqlite')
+    parser.add_argument('--config', default='database.config')
+    parser.add_argument('--config-name', default='whale_watch')
+    parser.add_argument('--schema')
+    parser.add_argument('--max-speed', type=float, default=50.0, help='knots')
+    parser.add_argument('--bucket-seconds', type=int)
+    parser.add_argument('--tolerance-km', type=float, help='Douglas-Peucker tolerance')
+    parser.add_argument('--chunk-rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.sqlite:
+        db = database.SQLiteDatabase(args.sqlite)
+    else:
+        db = database.PostgresDatabase(args.config, args.config_name)
+    source_table = database.PositionTable(db, schema=args.schema)
+    target_table = CleanPositionTable(db, schema=args.schema)
+    target_table.drop()
+    target_table.create()
+    cleaner = TrajectoryCleaner(args.max_speed, args.bucket_seconds, args.tolerance_km)
+    cleaner.run(source_table, target_table, args.chunk_rows)
@@ -0,0 +1,168 @@
+import collections
+import os
+import random
+import threading
+import time
+
+import requests
+import requests.adapters
+
+from metrics import registry
+
+USER_AGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:53.0) Gecko/20100101 Firefox/53.0'
+
+RETRYABLE_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, backoff)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = dict()
+        self.opened_at = dict()
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def allow(self, host):
+        with self.lock:
+            opened_at = self.opened_at.get(host)
+            if opened_at is None:
+                return True
+            return time.monotonic() - opened_at >= self.reset_timeout
+
+    def record_success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened_at.pop(host, None)
+
+    def record_failure(self, host):
+        with self.lock:
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.failure_threshold:
+                if host not in self.opened_at:
+                    self.trips += 1
+                    print('Circuit opened for {}'.format(host))
+                self.opened_at[host] = time.monotonic()
+
+
+class DeadLetterQueue:
+    def __init__(self, path=None):
+        self.path = path
+        self.urls = collections.OrderedDict()
+        self.lock = threading.Lock()
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, 'r') as infile:
+                for line in infile:
+                    url = line.strip()
+                    if url:
+                        self.urls[url] = None
+
+    def add(self, url):
+        with self.lock:
+            self.urls[url] = None
+            self.save()
+
+    def drain(self):
+        with self.lock:
+            urls = list(self.urls)
+            self.urls.clear()
+            self.save()
+        return urls
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path, 'w') as outfile:
+            for url in self.urls:
+                outfile.write(url + '\n')
+
+    def __len__(self):
+        return len(self.urls)
+
+
+class Transport:
+    def __init__(self, pool_size=10, conditional=True, latency_window=1000):
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': USER_AGENT})
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.conditional = conditional
+        self.validators = dict()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.not_modified = 0
+        self.latencies = collections.deque(maxlen=latency_window)
+        registry.gauge_function('http_new_connections', lambda: self.connection_counts()[0])
+
+    def get(self, url, timeout=None):
+        headers = dict()
+        if self.conditional and url in self.validators:
+            etag, last_modified = self.validators[url]
+            if etag is not None:
+                headers['If-None-Match'] = etag
+            if last_modified is not None:
+                headers['If-Modified-Since'] = last_modified
+        start = time.perf_counter()
+        try:
+            ret = self.session.get(url=url, headers=headers, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            registry.increment('http_errors_total', error=e.__class__.__name__)
+            raise
+        latency = time.perf_counter() - start
+        registry.observe('http_ttfb_seconds', ret.elapsed.total_seconds())
+        registry.observe('http_request_seconds', latency)
+        registry.increment('http_requests_total', status=ret.status_code)
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            if ret.status_code == 304:
+                self.not_modified += 1
+            elif ret.status_code == 200 and self.conditional:
+                etag = ret.headers.get('ETag')
+                last_modified = ret.headers.get('Last-Modified')
+                if etag is not None or last_modified is not None:
+                    self.validators[url] = (etag, last_modified)
+        return ret
+
+    def connection_counts(self):
+        new_connections = 0
+        pool_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            new_connections += pool.num_connections
+            pool_requests += pool.num_requests
+        return new_connections, pool_requests
+
+    def stats(self):
+        new_connections, pool_requests = self.connection_counts()
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {'requests': self.requests, 'not_modified': self.not_modified}
+        stats['new_connections'] = new_connections
+        if pool_requests > 0:
+            stats['reuse_rate'] = 1.0 - float(new_connections) / pool_requests
+        else:
+            stats['reuse_rate'] = None
+        if latencies:
+            stats['latency_mean'] = sum(latencies) / len(latencies)
+            stats['latency_p50'] = latencies[int(0.50 * (len(latencies) - 1))]
+            stats['latency_p99'] = latencies[int(0.99 * (len(latencies) - 1))]
+            stats['latency_max'] = latencies[-1]
+        return stats
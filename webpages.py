@@ -1,7 +1,8 @@
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, NavigableString, Tag
 import datetime
-import requests
-import time
+
+from metrics import registry
+from transport import Transport
 
 
 def sign_coordinate(coordinate):
@@ -20,11 +21,28 @@ def sign_coordinate(coordinate):
     return coordinate
 
 
+def parse_vessel_html(url, html):
+    vessel_page = VesselPage()
+    vessel_page.vessel_params['url'] = url
+    vessel_page.load_html(html)
+    if not vessel_page.in_database():
+        return None
+    vessel_page.parse()
+    return vessel_page.vessel_params
+
+
 class Webpage:
-    def __init__(self):
+    def __init__(self, transport=None):
         self.soup = None
         self.html = None
         self.table1 = None
+        self.not_modified = False
+        self.transport = transport
+
+    def load_html(self, html):
+        self.html = html
+        with registry.timer('parse_soup_seconds'):
+            self.soup = BeautifulSoup(html, 'lxml')
 
     def to_file(self):
         with open('page.html', 'w') as outfile:
@@ -32,52 +50,80 @@ class Webpage:
 
     def from_file(self):
         with open('page.html', 'r') as infile:
-            self.soup = BeautifulSoup(infile.read(), 'lxml')
+            self.load_html(infile.read())
 
 
 class VesselPage(Webpage):
-    def __init__(self):
-        super(VesselPage, self).__init__()
+    labels = frozenset(['Last report', 'AIS Type', 'Ship type', 'Flag', 'Coordinates', 'Course / Speed',
+                        'IMO / MMSI', 'IMO number', 'Year of Built', 'Length / Beam', 'Length Overall (m)',
+                        'Beam (m)', 'Gross Tonnage'])
+
+    def __init__(self, transport=None):
+        super(VesselPage, self).__init__(transport)
         self.vessel_params = dict()
         self.url = None
+        self.indexed_soup = None
+        self.label_index = None
+        self.error_tags = None
+
+    def build_index(self):
+        self.label_index = dict()
+        self.error_tags = []
+        for element in self.soup.descendants:
+            if isinstance(element, NavigableString):
+                if element in self.labels:
+                    self.label_index.setdefault(str(element), []).append(element)
+            elif isinstance(element, Tag) and element.name == 'p':
+                if 'col-md-8' in element.get('class', ()):
+                    self.error_tags.append(element)
+        self.indexed_soup = self.soup
+
+    def find_labels(self, label):
+        if self.indexed_soup is not self.soup:
+            self.build_index()
+        return self.label_index.get(label, [])
 
-    def download(self, url):
+    def find_label(self, label):
+        labels = self.find_labels(label)
+        if len(labels) > 0:
+            return labels[0]
+        return None
+
+    def fetch(self, url, timeout=None):
         self.vessel_params['url'] = url
-        session = requests.Session()
-        session.headers.update({'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:53.0) Gecko/20100101 Firefox/53.0'})
-        download_success = False
-        while download_success == False:
-            try:
-                ret = session.get(url=url)
-                self.html = ret.text
-                download_success = True
-            except requests.exceptions.ConnectionError:
-                print('Download Failed. Retrying in 5 Seconds')
-                time.sleep(5)
-
-        self.soup = BeautifulSoup(self.html, 'lxml')
+        if self.transport is None:
+            self.transport = Transport()
+        ret = self.transport.get(url=url, timeout=timeout)
+        self.html = ret.text
+        self.soup = None
+        self.not_modified = ret.status_code == 304
+        if self.not_modified:
+            self.html = None
+            return False
         if ret.status_code == 200:
             return True
         else:
             return False
 
+    def download(self, url, timeout=None):
+        success = self.fetch(url, timeout=timeout)
+        if self.html is not None:
+            self.load_html(self.html)
+        return success
+
+    extractors = ['get_name', 'get_report_date', 'get_type', 'get_country', 'get_location', 'get_speed',
+                  'get_imo', 'get_mmsi', 'get_built_year', 'get_length', 'get_width', 'get_gt']
+
     def parse(self):
-        self.get_name()
-        self.get_report_date()
-        self.get_type()
-        self.get_country()
-        self.get_location()
-        self.get_speed()
-        self.get_imo()
-        self.get_mmsi()
-        self.get_built_year()
-        self.get_length()
-        self.get_width()
-        self.get_gt()
-        
+        for extractor in self.extractors:
+            with registry.timer('parse_extractor_seconds', extractor=extractor):
+                getattr(self, extractor)()
+
     def in_database(self):
         in_database = True
-        error_tags = self.soup.find_all('p', 'col-md-8')
+        if self.indexed_soup is not self.soup:
+            self.build_index()
+        error_tags = self.error_tags
         if len(error_tags) > 0:
             error_string = error_tags[0].contents[0]
             if 'temporary not in our database' in error_string:
@@ -89,7 +135,7 @@ class VesselPage(Webpage):
         self.vessel_params['name'] = name
 
     def get_report_date(self):
-        date_tag = self.soup.find(text='Last report')
+        date_tag = self.find_label('Last report')
         if date_tag is not None:
             date_string = date_tag.parent.next_sibling.contents[1].strip()
             try:
@@ -103,14 +149,14 @@ class VesselPage(Webpage):
         self.vessel_params['date'] = timestamp        
 
     def get_type(self):
-        ship_type_tag = self.soup.find(text='AIS Type')
+        ship_type_tag = self.find_label('AIS Type')
         if ship_type_tag is None:
-            ship_type_tag = self.soup.find(text='Ship type')
+            ship_type_tag = self.find_label('Ship type')
         ship_type = ship_type_tag.parent.next_sibling.contents[0].strip()
         self.vessel_params['ship_type'] = ship_type
 
     def get_country(self):
-        country_tags = self.soup.find_all(text='Flag')
+        country_tags = self.find_labels('Flag')
         if len(country_tags[0].parent.next_sibling.contents) > 0:
             country = country_tags[0].parent.next_sibling.contents[0].strip()
         elif len(country_tags[1].parent.next_sibling.contents) > 0:
@@ -121,7 +167,7 @@ class VesselPage(Webpage):
         self.vessel_params['country'] = country
 
     def get_location(self):
-        coordiantes_tag = self.soup.find(text='Coordinates')
+        coordiantes_tag = self.find_label('Coordinates')
         if coordiantes_tag is not None:
             coordiantes_string = coordiantes_tag.parent.next_sibling.contents[0].strip()
             latitude = coordiantes_string.split('/')[0]
@@ -135,7 +181,7 @@ class VesselPage(Webpage):
         self.vessel_params['longitude'] = longitude
 
     def get_speed(self):
-        speed_tag = self.soup.find(text='Course / Speed')
+        speed_tag = self.find_label('Course / Speed')
         if speed_tag is not None:
             speed_string = speed_tag.parent.next_sibling.contents[0].strip()
             speed = speed_string.split('/')[1].split('kn')[0].strip()
@@ -149,12 +195,12 @@ class VesselPage(Webpage):
         self.vessel_params['speed'] = speed
 
     def get_imo(self):
-        if self.soup.find(text='IMO / MMSI') is not None:
-            imo_tag = self.soup.find(text='IMO / MMSI')
+        if self.find_label('IMO / MMSI') is not None:
+            imo_tag = self.find_label('IMO / MMSI')
             imo_string = imo_tag.parent.next_sibling.contents[0].strip()
             imo = imo_string.split('/')[0].strip()
-        elif self.soup.find(text='IMO number') is not None:
-            imo_tag = self.soup.find(text='IMO number')
+        elif self.find_label('IMO number') is not None:
+            imo_tag = self.find_label('IMO number')
             imo = imo_tag.parent.next_sibling.contents[0].strip()
         try:
             imo = int(imo)
@@ -164,8 +210,8 @@ class VesselPage(Webpage):
         self.vessel_params['imo'] = imo
 
     def get_mmsi(self):
-        if self.soup.find(text='IMO / MMSI') is not None:
-            mmsi_tag = self.soup.find(text='IMO / MMSI')
+        if self.find_label('IMO / MMSI') is not None:
+            mmsi_tag = self.find_label('IMO / MMSI')
             mmsi_string = mmsi_tag.parent.next_sibling.contents[0].strip()
             mmsi = mmsi_string.split('/')[1].strip()
             try:
@@ -178,7 +224,7 @@ class VesselPage(Webpage):
         self.vessel_params['mmsi'] = mmsi
 
     def get_built_year(self):
-        built_string = self.soup.find(text='Year of Built').parent.next_sibling.contents[0].strip()
+        built_string = self.find_label('Year of Built').parent.next_sibling.contents[0].strip()
         try:
             built = int(built_string)
         except ValueError:
@@ -187,12 +233,12 @@ class VesselPage(Webpage):
         self.vessel_params['built'] = built
 
     def get_length(self):
-        if self.soup.find(text='Length / Beam') is not None:
-            length_tag = self.soup.find(text='Length / Beam')
+        if self.find_label('Length / Beam') is not None:
+            length_tag = self.find_label('Length / Beam')
             length_string = length_tag.parent.next_sibling.contents[0].strip()
             length_string = length_string.split('/')[0].strip()
-        elif self.soup.find(text='Length Overall (m)') is not None:
-            length_tag = self.soup.find(text='Length Overall (m)')
+        elif self.find_label('Length Overall (m)') is not None:
+            length_tag = self.find_label('Length Overall (m)')
             length_string = length_tag.parent.next_sibling.contents[0].strip()
         try:
             length = float(length_string)
@@ -205,15 +251,15 @@ class VesselPage(Webpage):
         self.vessel_params['length'] = length
 
     def get_width(self):
-        if self.soup.find(text='Length / Beam') is not None:
-            width_tag = self.soup.find(text='Length / Beam')
+        if self.find_label('Length / Beam') is not None:
+            width_tag = self.find_label('Length / Beam')
             width_string = width_tag.parent.next_sibling.contents[0].strip()
             if len(width_string.split('/')) > 1:
                 width_string = width_string.split('/')[1].strip().split(' ')[0]
             else:
                 width_string = None
-        elif self.soup.find(text='Beam (m)') is not None:
-            width_tag = self.soup.find(text='Beam (m)')
+        elif self.find_label('Beam (m)') is not None:
+            width_tag = self.find_label('Beam (m)')
             width_string = width_tag.parent.next_sibling.contents[0].strip()
         try:
             width = float(width_string)
@@ -223,7 +269,7 @@ class VesselPage(Webpage):
         self.vessel_params['width'] = width
 
     def get_gt(self):
-        gt_string = self.soup.find(text='Gross Tonnage').parent.next_sibling.contents[0].strip()
+        gt_string = self.find_label('Gross Tonnage').parent.next_sibling.contents[0].strip()
         try:
             gt = float(gt_string)
         except ValueError:
@@ -0,0 +1,142 @@
+import bisect
+import hashlib
+import os
+import socket
+import time
+import uuid
+
+import database
+from frontier import canonical_url
+from scheduler import PollScheduler
+
+
+def stable_hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def shard_for(vessel_key, n_shards):
+    return stable_hash(vessel_key) % n_shards
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=64):
+        self.points = sorted((stable_hash('{}#{}'.format(node, replica)), node)
+                             for node in nodes for replica in range(replicas))
+        self.hashes = [point for point, node in self.points]
+
+    def owner(self, value):
+        if not self.points:
+            return None
+        i = bisect.bisect(self.hashes, stable_hash(value)) % len(self.points)
+        return self.points[i][1]
+
+
+class WorkQueue:
+    def __init__(self, db, schema=None, worker_id=None, n_shards=1024, lease_seconds=300, heartbeat_interval=30,
+                 worker_timeout=90, claim_size=100, scheduler=None):
+        self.table = database.WorkQueueTable(db, schema=schema)
+        self.workers = database.WorkerTable(db, schema=schema)
+        self.table.create()
+        self.workers.create()
+        if worker_id is None:
+            worker_id = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.worker_id = worker_id
+        self.n_shards = n_shards
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_timeout = worker_timeout
+        self.claim_size = claim_size
+        if scheduler is None:
+            scheduler = PollScheduler()
+        self.scheduler = scheduler
+        self.pending = dict()
+        self.leases = dict()
+        self.shards = []
+        self.last_heartbeat = None
+        self.heartbeat()
+
+    def add(self, url, due=None):
+        vessel_key, url = canonical_url(url)
+        if vessel_key is None:
+            return
+        if due is None:
+            due = time.time()
+        self.pending[vessel_key] = (vessel_key, url, shard_for(vessel_key, self.n_shards), due,
+                                    self.scheduler.default_interval, 0)
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        self.table.enqueue(list(self.pending.values()))
+        self.table.commit()
+        self.pending.clear()
+
+    def heartbeat(self, now=None):
+        if now is None:
+            now = time.time()
+        self.workers.heartbeat(self.worker_id, socket.gethostname(), now)
+        self.table.extend_leases(self.worker_id, now + self.lease_seconds)
+        live_workers = self.workers.live_workers(now - self.worker_timeout)
+        self.workers.commit()
+        ring = HashRing(live_workers)
+        self.shards = [shard for shard in range(self.n_shards) if ring.owner(str(shard)) == self.worker_id]
+        self.last_heartbeat = now
+
+    def heartbeat_if_due(self):
+        now = time.time()
+        if now - self.last_heartbeat >= self.heartbeat_interval:
+            self.heartbeat(now)
+
+    def due_urls(self, now=None):
+        if now is None:
+            now = time.time()
+        self.flush()
+        self.heartbeat_if_due()
+        rows = self.table.claim(self.worker_id, self.shards, now, now + self.lease_seconds, self.claim_size)
+        for vessel_key, url, interval, attempts in rows:
+            self.leases[url] = (vessel_key, interval, attempts)
+        return [url for vessel_key, url, interval, attempts in rows]
+
+    def release(self, url, interval, attempts):
+        lease = self.leases.pop(url, None)
+        if lease is None:
+            return
+        self.table.release(lease[0], self.worker_id, time.time() + interval, interval, attempts)
+        self.table.commit()
+        self.heartbeat_if_due()
+
+    def record_success(self, url, vessel_params):
+        self.release(url, self.scheduler.success_interval(vessel_params), 0)
+
+    def record_failure(self, url):
+        lease = self.leases.get(url)
+        if lease is None:
+            return
+        attempts = lease[2] + 1
+        self.release(url, self.scheduler.next_interval(None, None, attempts), attempts)
+
+    def settle(self, unchanged_urls=()):
+        for url in unchanged_urls:
+            lease = self.leases.get(url)
+            if lease is not None:
+                self.release(url, lease[1] or self.scheduler.default_interval, 0)
+        for url in list(self.leases):
+            self.record_failure(url)
+
+    def save(self):
+        self.flush()
+
+    def seconds_until_next(self, now=None):
+        if now is None:
+            now = time.time()
+        wait = self.heartbeat_interval
+        next_due = self.table.next_due(self.shards)
+        if next_due is not None:
+            wait = min(wait, next_due - now)
+        return max(0, wait)
+
+    def close(self):
+        self.flush()
+        self.table.release_all(self.worker_id)
+        self.workers.remove(self.worker_id)
+        self.table.commit()